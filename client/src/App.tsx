@@ -6,11 +6,28 @@ import "./App.css"; // Import CSS hiện tại
 // Định nghĩa kiểu dữ liệu cho response từ backend
 interface ProcessResponse {
   status: string;
+  jobId?: string;
   successfulFiles?: number;
   totalRowsAdded?: number;
+  errors?: string[];
   error: boolean;
 }
 
+// Trạng thái job xử lý nền trả về từ /jobs/<jobId>
+interface JobStatusResponse {
+  jobId: string;
+  state: "queued" | "running" | "uploading" | "done" | "failed";
+  processedFiles: number;
+  totalFiles: number;
+  result?: ProcessResponse;
+  status?: string;
+  error: boolean;
+}
+
+const POLL_INTERVAL_MS = 1000;
+
+const sleep = (ms: number) => new Promise((resolve) => setTimeout(resolve, ms));
+
 function App() {
   const [files, setFiles] = useState<File[]>([]);
   const [googleSheetUrl, setGoogleSheetUrl] = useState<string>(
@@ -110,14 +127,54 @@ function App() {
         }
       );
 
+      if (response.data.error || !response.data.jobId) {
+        setStatus({
+          message: response.data.status,
+          isError: response.data.error,
+          isSuccess: false,
+        });
+        return;
+      }
+
+      // Server xử lý nền, poll trạng thái job đến khi hoàn tất
+      let result: ProcessResponse | undefined;
+      while (!result) {
+        await sleep(POLL_INTERVAL_MS);
+        const jobResponse = await axios.get<JobStatusResponse>(
+          `https://upload1-2h85.onrender.com/jobs/${response.data.jobId}`
+          // `http://127.0.0.1:5000/jobs/${response.data.jobId}`
+        );
+        const job = jobResponse.data;
+        if (job.error) {
+          setStatus({
+            message: job.status || "Lỗi không xác định",
+            isError: true,
+            isSuccess: false,
+          });
+          return;
+        }
+        if (job.result) {
+          result = job.result;
+        } else {
+          setStatus({
+            message:
+              job.state === "uploading"
+                ? "Đang tải dữ liệu lên Google Sheets..."
+                : `Đang xử lý: ${job.processedFiles}/${job.totalFiles} file...`,
+            isError: false,
+            isSuccess: false,
+          });
+        }
+      }
+
       setStatus({
-        message: response.data.status,
-        isError: false,
-        isSuccess: response.data.successfulFiles !== undefined,
+        message: result.status,
+        isError: result.error,
+        isSuccess: !result.error && result.successfulFiles !== undefined,
       });
-      if (response.data.successfulFiles && response.data.totalRowsAdded) {
+      if (result.successfulFiles && result.totalRowsAdded) {
         setStatus({
-          message: `Hoàn tất toàn bộ quá trình: Tổng số file được thêm thành công: ${response.data.successfulFiles}, Tổng số hàng được thêm: ${response.data.totalRowsAdded}`,
+          message: `Hoàn tất toàn bộ quá trình: Tổng số file được thêm thành công: ${result.successfulFiles}, Tổng số hàng được thêm: ${result.totalRowsAdded}`,
           isError: false,
           isSuccess: true,
         });
@@ -0,0 +1,131 @@
+import os
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Mã buổi lưu trong cột sessions (1 byte/bản ghi)
+SESSIONS = ("Buổi sáng", "Buổi chiều")
+SESSION_MORNING = 0
+SESSION_AFTERNOON = 1
+
+ATTENDANCE = "Nghỉ học"
+
+# Tháng bắt đầu năm học: ngày "dd/mm" từ tháng này trở đi xếp trước các tháng nhỏ hơn (học kỳ 1 kéo dài từ tháng 9 tới tháng 1)
+SCHOOL_YEAR_START_MONTH = int(os.getenv('SCHOOL_YEAR_START_MONTH', '8'))
+
+def date_key(date_value: str, start_month: int = SCHOOL_YEAR_START_MONTH) -> Optional[int]:
+    """
+    Khóa so sánh của ngày dạng "dd/mm" trong năm học bắt đầu từ start_month:
+    (số tháng tính từ start_month) * 100 + ngày, nên 15/12 < 15/01. Giá trị không đúng dạng trả về None.
+    """
+    parts = date_value.split('/')
+    if len(parts) >= 2 and parts[0].strip().isdigit() and parts[1].strip().isdigit():
+        month = int(parts[1])
+        if 1 <= month <= 12:
+            return (month - start_month) % 12 * 100 + int(parts[0])
+    return None
+
+class AbsenceRecords:
+    """
+    Bảng bản ghi nghỉ học dạng cột: mỗi cột là array số nguyên trỏ vào bảng giá trị đã intern
+    (ngày, họ tên, khoa, lớp), nên bộ nhớ tăng theo số giá trị khác nhau thay vì số hàng x 8 ô.
+    """
+
+    __slots__ = ("values", "_value_ids", "dates", "names", "faculties", "classes", "sessions")
+
+    def __init__(self):
+        self.values: List[str] = []
+        self._value_ids: Dict[str, int] = {}
+        self.dates = array('I')
+        self.names = array('I')
+        self.faculties = array('I')
+        self.classes = array('I')
+        self.sessions = array('B')
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def __getstate__(self):
+        return {"values": self.values,
+                "columns": (self.dates, self.names, self.faculties, self.classes, self.sessions)}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.values = list(state["values"])
+        self._value_ids = {value: idx for idx, value in enumerate(self.values)}
+        dates, names, faculties, classes, sessions = state["columns"]
+        self.dates.extend(dates)
+        self.names.extend(names)
+        self.faculties.extend(faculties)
+        self.classes.extend(classes)
+        self.sessions.extend(sessions)
+
+    def intern(self, value: str) -> int:
+        idx = self._value_ids.get(value)
+        if idx is None:
+            idx = self._value_ids[value] = len(self.values)
+            self.values.append(value)
+        return idx
+
+    def append(self, date_value: str, full_name: str, faculty_name: str, class_name: str, session: int):
+        self.dates.append(self.intern(date_value))
+        self.names.append(self.intern(full_name))
+        self.faculties.append(self.intern(faculty_name))
+        self.classes.append(self.intern(class_name))
+        self.sessions.append(session)
+
+    def extend(self, other: "AbsenceRecords"):
+        """
+        Gộp bản ghi của bảng khác (ví dụ các file trong cùng một lô), ánh xạ lại chỉ số giá trị.
+        """
+        remap = array('I', (self.intern(value) for value in other.values))
+        self.dates.extend(remap[idx] for idx in other.dates)
+        self.names.extend(remap[idx] for idx in other.names)
+        self.faculties.extend(remap[idx] for idx in other.faculties)
+        self.classes.extend(remap[idx] for idx in other.classes)
+        self.sessions.extend(other.sessions)
+
+    def __iter__(self) -> Iterator[Tuple[str, str, str, str, str]]:
+        """
+        Duyệt từng bản ghi dạng (ngày, họ tên, khoa, lớp, buổi).
+        """
+        values = self.values
+        for date_idx, name_idx, faculty_idx, class_idx, session in zip(
+                self.dates, self.names, self.faculties, self.classes, self.sessions):
+            yield values[date_idx], values[name_idx], values[faculty_idx], values[class_idx], SESSIONS[session]
+
+    def to_sheet_rows(self) -> List[List[str]]:
+        """
+        Ánh xạ một lượt sang cột A-H của Google Sheets:
+        "", Ngày, Phòng, Họ và tên HSSV, Khoa, Lớp, Giáo viên giảng dạy, Nề nếp Buổi.
+        """
+        values = self.values
+        # Gộp "Nề nếp" và "Buổi" thành một chuỗi cho cột H, tính sẵn cho từng mã buổi
+        combined = [f"{ATTENDANCE} {session}" for session in SESSIONS]
+        return [
+            ["", values[date_idx], "", values[name_idx], values[faculty_idx], values[class_idx], "", combined[session]]
+            for date_idx, name_idx, faculty_idx, class_idx, session in zip(
+                self.dates, self.names, self.faculties, self.classes, self.sessions)
+        ]
+
+    def to_columns(self) -> Tuple[List[int], ...]:
+        return (self.dates.tolist(), self.names.tolist(), self.faculties.tolist(),
+                self.classes.tolist(), self.sessions.tolist())
+
+    def to_dict(self) -> dict:
+        """
+        Dạng JSON-serializable (dùng cho cache trên đĩa).
+        """
+        return {"values": self.values, "columns": self.to_columns()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "AbsenceRecords":
+        records = cls.__new__(cls)
+        records.__setstate__(data)
+        return records
+
+    @classmethod
+    def concat(cls, parts: Iterable["AbsenceRecords"]) -> "AbsenceRecords":
+        merged = cls()
+        for part in parts:
+            merged.extend(part)
+        return merged
@@ -0,0 +1,71 @@
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from absence_records import AbsenceRecords, SESSION_MORNING, date_key
+
+# Tên tab thống kê mặc định: "<tab chi tiết>_Thong_ke"
+SUMMARY_SHEET_SUFFIX = "_Thong_ke"
+
+class AbsenceSummary:
+    """
+    Số lượt nghỉ theo học sinh, lớp và ngày của cả lô, tách buổi sáng/chiều.
+    Mỗi thống kê là dict khóa -> [tổng, sáng, chiều]; khóa là chuỗi đã intern trong AbsenceRecords.
+    """
+
+    def __init__(self):
+        self.students: Dict[Tuple[str, str], List[int]] = {}   # (lớp, họ tên)
+        self.classes: Dict[str, List[int]] = {}
+        self.class_students: Counter = Counter()               # lớp -> số học sinh có nghỉ
+        self.dates: Dict[str, List[int]] = {}
+        self.total = 0
+
+    @classmethod
+    def from_records(cls, records: AbsenceRecords) -> "AbsenceSummary":
+        """
+        Đếm một lượt trên các cột chỉ số của AbsenceRecords (Counter trên zip chạy ở tầng C),
+        sau đó chỉ cộng dồn trên các tổ hợp khác nhau thay vì từng bản ghi.
+        """
+        summary = cls()
+        counts = Counter(zip(records.classes, records.names, records.dates, records.sessions))
+        values = records.values
+
+        students: Dict[Tuple[int, int], List[int]] = {}
+        classes: Dict[int, List[int]] = {}
+        dates: Dict[int, List[int]] = {}
+        for (class_idx, name_idx, date_idx, session), count in counts.items():
+            slot = 1 if session == SESSION_MORNING else 2
+            for table, key in ((students, (class_idx, name_idx)), (classes, class_idx), (dates, date_idx)):
+                totals = table.get(key)
+                if totals is None:
+                    totals = table[key] = [0, 0, 0]
+                totals[0] += count
+                totals[slot] += count
+
+        summary.students = {(values[class_idx], values[name_idx]): totals
+                            for (class_idx, name_idx), totals in students.items()}
+        summary.classes = {values[class_idx]: totals for class_idx, totals in classes.items()}
+        summary.class_students = Counter(values[class_idx] for class_idx, _ in students)
+        summary.dates = {values[date_idx]: totals for date_idx, totals in dates.items()}
+        summary.total = len(records)
+        return summary
+
+    def to_sheet_rows(self) -> List[List]:
+        """
+        Bảng thống kê gọn cho một tab: ba phần (học sinh, lớp, ngày) xếp liên tiếp, cách nhau một hàng trống.
+        """
+        rows: List[List] = [["Thống kê theo học sinh"],
+                            ["Lớp", "Họ và tên HSSV", "Số lượt nghỉ", "Buổi sáng", "Buổi chiều"]]
+        for (class_name, full_name), totals in sorted(self.students.items()):
+            rows.append([class_name, full_name] + totals)
+
+        rows += [[], ["Thống kê theo lớp"], ["Lớp", "Số HSSV nghỉ", "Số lượt nghỉ", "Buổi sáng", "Buổi chiều"]]
+        for class_name, totals in sorted(self.classes.items()):
+            rows.append([class_name, self.class_students[class_name]] + totals)
+
+        rows += [[], ["Thống kê theo ngày"], ["Ngày", "Số lượt nghỉ", "Buổi sáng", "Buổi chiều"]]
+        # Theo thứ tự trong năm học, giá trị không phải ngày xếp cuối theo chuỗi
+        for date_value in sorted(self.dates, key=lambda value: (date_key(value) is None, date_key(value) or 0, value)):
+            rows.append([date_value] + self.dates[date_value])
+
+        rows += [[], ["Tổng số lượt nghỉ", self.total]]
+        return rows
@@ -1,23 +1,52 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
 import os
-from handleExcel import copy_dates_and_add_columns, summarize_k_attendance
-from uploadGgSheet import extract_spreadsheet_id, upload_to_google_sheets, connect_to_google_sheets
-from network_checker import check_network, check_internet_speed
-import tempfile
-import openpyxl
+from werkzeug.exceptions import RequestEntityTooLarge
+from jobs import submit_job, get_job_status
+from pipeline import release_uploads, start_process_pool
+from upload_stream import MAX_UPLOAD_REQUEST_BYTES, UploadTooLarge, parse_multipart_stream
+from result_cache import result_cache
+from attendance_store import attendance_store
+from uploadGgSheet import extract_spreadsheet_id, connect_to_google_sheets, warm_up_google_sheets
+from network_checker import network_prober
+from metrics import RequestMetrics, registry
 from dotenv import load_dotenv
+from logging_config import configure_logging
 
 import logging
-import shutil
+import threading
+import multiprocessing
 
 load_dotenv()
 CREDENTIALS_FILE = os.getenv('GOOGLE_CREDENTIALS_PATH', 'credentials.json')
+UPLOAD_DIFF_MODE = os.getenv('UPLOAD_DIFF_MODE', '0')
+# Nhận file theo chế độ streaming (đọc body theo chunk, file lớn được ghi ra đĩa); 0 = dùng request.files như cũ
+UPLOAD_STREAMING = os.getenv('UPLOAD_STREAMING', '1').lower() in ('1', 'true', 'yes')
 
-logging.basicConfig(level=logging.DEBUG)
+configure_logging()
 
 app = Flask(__name__)
-CORS(app, resources={r"/check-network": {"origins": "*"}, r"/process": {"origins": "*"}})
+# Giới hạn kích thước request cho chế độ request.files (chế độ streaming tự kiểm tra trong parse_multipart_stream)
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_REQUEST_BYTES
+CORS(app, resources={r"/check-network": {"origins": "*"}, r"/process": {"origins": "*"}, r"/aggregate": {"origins": "*"}, r"/jobs/*": {"origins": "*"}, r"/attendance": {"origins": "*"}})
+
+def start_background_tasks():
+    """
+    Khởi động thread nền của process phục vụ request: khởi tạo sẵn Google Sheets client
+    (request đầu tiên không phải chờ), kiểm tra mạng định kỳ và đồng bộ attendance store lên Sheets.
+    Thread không tồn tại qua fork nên với gunicorn hàm này được gọi trong post_fork của từng worker.
+    Process pool được tạo trước tiên, khi process chưa có thread nền nào.
+    """
+    start_process_pool()
+    threading.Thread(target=warm_up_google_sheets, name="sheets-warm-up", daemon=True).start()
+    network_prober.start()
+    attendance_store.start()
+
+# gunicorn.conf.py đặt APP_DEFER_BACKGROUND=1 để không khởi động thread trong process master.
+# Process con của pool (forkserver/spawn) import lại module chính khi chạy python app.py: không khởi động gì ở đó
+if (os.getenv('APP_DEFER_BACKGROUND', '0').lower() not in ('1', 'true', 'yes')
+        and multiprocessing.parent_process() is None):
+    start_background_tasks()
 
 @app.route('/', methods=['GET'])
 def home():
@@ -25,122 +54,109 @@ def home():
 
 @app.route('/check-network', methods=['POST', 'GET'])
 def check_network_status():
-    is_connected, network_message = check_network()
-    if not is_connected:
-        return jsonify({"error": True, "message": network_message})
-    
-    is_speed_ok, speed_message = check_internet_speed()
-    if not is_speed_ok:
-        return jsonify({"error": True, "message": speed_message})
-    
-    message = f"{network_message} - {speed_message}" if "Mạng chậm" in network_message or "Mạng chậm" in speed_message else "Mạng ổn định."
-    logging.info(message)
-    return jsonify({"error": False, "message": message})
+    # Trả trạng thái đã được kiểm tra ở nền, không chặn request
+    return jsonify(network_prober.status())
 
 @app.route('/process', methods=['POST'])
 def process_files():
-    files = request.files.getlist('files')
-    google_sheet_url = request.form.get('googleSheetUrl')
-    sheet_name = request.form.get('sheetName')
-    faculty_name = request.form.get('faculty')
+    return _handle_upload_request(aggregate=False)
 
-    if not files or not google_sheet_url or not sheet_name or not faculty_name:
-        return jsonify({"status": "Lỗi: Thiếu thông tin!", "error": True})
+@app.route('/aggregate', methods=['POST'])
+def aggregate_files():
+    # Cùng form với /process (thêm summarySheetName tùy chọn), chỉ ghi tab thống kê theo học sinh/lớp/ngày
+    return _handle_upload_request(aggregate=True)
+
+def _handle_upload_request(aggregate: bool):
+    metrics = RequestMetrics()
+    try:
+        form, uploads = _read_uploads(metrics)
+    except (UploadTooLarge, RequestEntityTooLarge) as e:
+        logging.warning(f"Rejected upload: {e}")
+        return jsonify({"status": f"Lỗi: {e.description if isinstance(e, RequestEntityTooLarge) else e}!", "error": True})
+    except Exception as e:
+        logging.error(f"Error reading upload: {e}")
+        return jsonify({"status": "Lỗi: Không đọc được dữ liệu upload!", "error": True})
+
+    response, job = _queue_uploads(form, uploads, metrics, aggregate)
+    if job is None:
+        # Không tạo được job: xóa ngay file tạm của các file đã nhận
+        release_uploads(uploads)
+    return jsonify(response)
+
+def _read_uploads(metrics: RequestMetrics):
+    """
+    Trả về (form, [(tên file, nội dung)]).
+    Chế độ streaming đọc body theo chunk, kiểm tra giới hạn kích thước ngay khi nhận và ghi mỗi file ra SpooledUpload;
+    chế độ cũ dùng request.files (Werkzeug đệm cả body, mọi file nằm trong bộ nhớ tới khi job xong).
+    """
+    with metrics.stage("read_uploads"):
+        if UPLOAD_STREAMING:
+            form, files = parse_multipart_stream(request.stream, request.content_type, request.content_length)
+            return form, [(upload.filename, upload) for upload in files]
+        return request.form, [(file.filename, file.read()) for file in request.files.getlist('files')]
+
+def _queue_uploads(form, uploads, metrics: RequestMetrics, aggregate: bool):
+    google_sheet_url = form.get('googleSheetUrl')
+    sheet_name = form.get('sheetName')
+    faculty_name = form.get('faculty')
+    # Chế độ diff: chỉ ghi các hàng chưa có trên sheet (mặc định theo UPLOAD_DIFF_MODE)
+    diff = form.get('diff', UPLOAD_DIFF_MODE).lower() in ('1', 'true', 'yes')
+    # ?timings=1 (hoặc trường form timings) trả thêm thời gian từng bước trong kết quả job
+    include_timings = request.args.get('timings', form.get('timings', '0')).lower() in ('1', 'true', 'yes')
+
+    if not uploads or not google_sheet_url or not sheet_name or not faculty_name:
+        return {"status": "Lỗi: Thiếu thông tin!", "error": True}, None
 
     spreadsheet_id = extract_spreadsheet_id(google_sheet_url)
     if not spreadsheet_id:
-        return jsonify({"status": "Lỗi: URL Google Sheet không hợp lệ!", "error": True})
+        return {"status": "Lỗi: URL Google Sheet không hợp lệ!", "error": True}, None
 
     service = connect_to_google_sheets(spreadsheet_id)
     if not service:
-        return jsonify({"status": "Lỗi: Không kết nối được Google Sheets!", "error": True})
-
-    successful_files = 0
-    total_rows_added = 0
-    temp_dir = tempfile.mkdtemp()
-    errors = []
-
-    for file in files:
-        if not file.filename.lower().endswith('.xlsx'):
-            errors.append(f"Bỏ qua '{file.filename}': Không phải Excel.")
-            continue
-
-        file_path = os.path.join(temp_dir, file.filename)
-        file.save(file_path)
-        logging.debug(f"Saved file: {file_path}")
-
-        if not copy_dates_and_add_columns(file_path):
-            errors.append(f"Lỗi: Không xử lý được ngày và cột cho '{file.filename}'.")
-            continue
-
-        is_valid, error_message = validate_excel_data(file_path)
-        if not is_valid:
-            errors.append(f"Lỗi file '{file.filename}': {error_message}")
-            continue
-
-        rows_added = process_single_file(file_path, spreadsheet_id, sheet_name, faculty_name, service)
-        if rows_added is not False:
-            successful_files += 1
-            total_rows_added += rows_added
-        else:
-            errors.append(f"Lỗi xử lý file '{file.filename}'.")
-
-    shutil.rmtree(temp_dir)
-    status = f"Xử lý hoàn tất: {successful_files} file thành công, {total_rows_added} hàng."
-    response = {"status": status, "successfulFiles": successful_files, "totalRowsAdded": total_rows_added, "error": False}
-    if errors:
-        response["errors"] = errors
-    logging.info(status)
-    return jsonify(response)
-
-def validate_excel_data(file_path):
-    try:
-        workbook = openpyxl.load_workbook(file_path)
-        sheet = workbook.active
-        
-        if sheet.max_row < 4:
-            return False, "File cần ít nhất 4 hàng."
-        for row in range(4, sheet.max_row + 1):
-            if not sheet[f'C{row}'].value or not sheet[f'D{row}'].value:
-                return False, f"Thiếu họ tên ở hàng {row}."
-        
-        has_date = False
-        for col in range(7, sheet.max_column + 1):
-            date_value = sheet.cell(row=1, column=col).value
-            if isinstance(date_value, str) and '/' in date_value:
-                has_date = True
-                break
-        if not has_date:
-            return False, "Không tìm thấy ngày hợp lệ."
-        
-        return True, ""
-    except Exception as e:
-        return False, f"Lỗi kiểm tra dữ liệu: {str(e)}"
-
-def process_single_file(file_path, spreadsheet_id, sheet_name, faculty_name, service):
+        return {"status": "Lỗi: Không kết nối được Google Sheets!", "error": True}, None
+
+    # Lưu file vào job, xử lý và upload được thực hiện ở nền
+    job = submit_job(uploads, faculty_name, spreadsheet_id, sheet_name, service, diff, metrics, include_timings,
+                     aggregate, form.get('summarySheetName') or None)
+    if job is None:
+        return {"status": "Lỗi: Máy chủ đang bận, vui lòng thử lại sau!", "error": True}, None
+
+    return {"status": "Đã nhận file, đang xử lý...", "jobId": job.id, "error": False}, job
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = get_job_status(job_id)
+    if job is None:
+        return jsonify({"status": "Lỗi: Không tìm thấy job!", "error": True})
+    job["error"] = False
+    return jsonify(job)
+
+@app.route('/attendance', methods=['GET'])
+def attendance_query():
+    # Truy vấn bản ghi nghỉ học đã lưu trong store cục bộ: ?googleSheetUrl=&sheetName=&from=dd/mm&to=dd/mm&className=
+    if not attendance_store.enabled:
+        return jsonify({"status": "Lỗi: Chưa bật lưu trữ cục bộ (ATTENDANCE_STORE_PATH)!", "error": True})
+    spreadsheet_id = extract_spreadsheet_id(request.args.get('googleSheetUrl', ''))
+    sheet_name = request.args.get('sheetName')
+    if not spreadsheet_id or not sheet_name:
+        return jsonify({"status": "Lỗi: Thiếu thông tin!", "error": True})
     try:
-        if not summarize_k_attendance(file_path, faculty_name):
-            logging.error(f"Failed to summarize attendance for {file_path}")
-            return False
-
-        workbook = openpyxl.load_workbook(file_path)
-        if "Thống kê nghỉ học" not in workbook.sheetnames:
-            logging.error(f"Sheet 'Thống kê nghỉ học' not found in {file_path} after summarize")
-            return False
-        
-        summary_sheet = workbook["Thống kê nghỉ học"]
-        rows_added = summary_sheet.max_row - 1  # Trừ header
-        logging.debug(f"Summary sheet has {rows_added} rows of data")
-        
-        if not upload_to_google_sheets(file_path, spreadsheet_id, sheet_name, service):
-            logging.error(f"Failed to upload {file_path}")
-            return False
-        
-        logging.debug(f"Processed {file_path}: {rows_added} rows.")
-        return rows_added
-    except Exception as e:
-        logging.error(f"Error processing {file_path}: {e}")
-        return False
+        result = attendance_store.query(spreadsheet_id, sheet_name, request.args.get('from'), request.args.get('to'),
+                                        request.args.get('className'))
+    except ValueError as e:
+        return jsonify({"status": f"Lỗi: {e}!", "error": True})
+    result["error"] = False
+    return jsonify(result)
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    # Số liệu dạng text của Prometheus
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
 
 if __name__ == '__main__':
+    # Server phát triển (một process); production chạy qua gunicorn: gunicorn -c gunicorn.conf.py
     app.run(debug=False, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,340 @@
+import os
+import time
+import logging
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Tuple
+
+from absence_records import ATTENDANCE, SCHOOL_YEAR_START_MONTH, SESSIONS, AbsenceRecords, date_key
+from metrics import registry
+from sheets_writer import is_permanent_error
+from uploadGgSheet import connect_to_google_sheets, write_rows
+
+# File SQLite lưu bản ghi nghỉ học trước khi đồng bộ lên Google Sheets (để trống = tắt, ghi thẳng lên Sheets như cũ).
+# Các worker gunicorn dùng chung một file: SQLite (WAL) tự xử lý ghi đồng thời giữa các process
+ATTENDANCE_STORE_PATH = os.getenv('ATTENDANCE_STORE_PATH', '')
+# Chu kỳ (giây) thread nền kiểm tra bản ghi chưa đồng bộ
+ATTENDANCE_FLUSH_INTERVAL = float(os.getenv('ATTENDANCE_FLUSH_INTERVAL', '2'))
+# Số hàng tối đa mỗi lần đồng bộ một sheet (SheetsWriter tự chia chunk bên trong)
+ATTENDANCE_FLUSH_BATCH_ROWS = int(os.getenv('ATTENDANCE_FLUSH_BATCH_ROWS', '20000'))
+# Chờ tối đa (giây) trước khi thử lại một sheet đồng bộ lỗi (Sheets API lỗi, hết quota...)
+ATTENDANCE_RETRY_MAX = float(os.getenv('ATTENDANCE_RETRY_MAX', '300'))
+# Một worker giữ quyền đồng bộ một sheet tối đa bấy nhiêu giây (worker chết giữa chừng thì worker khác nhận lại)
+ATTENDANCE_LEASE_SECONDS = float(os.getenv('ATTENDANCE_LEASE_SECONDS', '600'))
+# Số bản ghi tối đa trả về cho một truy vấn
+ATTENDANCE_QUERY_LIMIT = int(os.getenv('ATTENDANCE_QUERY_LIMIT', '10000'))
+
+SheetKey = Tuple[str, str]
+
+# Trạng thái đồng bộ của một bản ghi (cột flushed)
+SYNC_PENDING = 0
+SYNC_DONE = 1
+SYNC_FAILED = 2     # Sheets từ chối vĩnh viễn (403/404/400...), không thử lại; lý do nằm ở sync_error
+SYNC_STATES = {SYNC_PENDING: "pending", SYNC_DONE: "synced", SYNC_FAILED: "failed"}
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS absences (
+    id INTEGER PRIMARY KEY,
+    spreadsheet_id TEXT NOT NULL,
+    sheet_name TEXT NOT NULL,
+    date TEXT NOT NULL,
+    date_key INTEGER,
+    full_name TEXT NOT NULL,
+    faculty TEXT NOT NULL,
+    class_name TEXT NOT NULL,
+    session INTEGER NOT NULL,
+    flushed INTEGER NOT NULL DEFAULT 0,
+    sync_error TEXT
+);
+CREATE INDEX IF NOT EXISTS absences_by_date ON absences (spreadsheet_id, sheet_name, date_key, class_name);
+CREATE INDEX IF NOT EXISTS absences_pending ON absences (spreadsheet_id, sheet_name, id) WHERE flushed = 0;
+CREATE TABLE IF NOT EXISTS store_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS flush_leases (
+    spreadsheet_id TEXT NOT NULL,
+    sheet_name TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL,
+    failures INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (spreadsheet_id, sheet_name)
+);
+"""
+
+class AttendanceStore:
+    """
+    Bộ đệm ghi sau (write-behind) trước Google Sheets: bản ghi của một lô được commit vào SQLite ngay trong job,
+    thread nền đồng bộ lên Sheets theo lô lớn và đánh dấu đã đồng bộ. Sheets lỗi hoặc hết quota thì bản ghi
+    vẫn nằm trong store và được thử lại, giáo viên không phải upload lại.
+    Store cũng trả lời truy vấn theo khoảng ngày/lớp mà không gọi Sheets API.
+    """
+
+    def __init__(self, path: str = ATTENDANCE_STORE_PATH, interval: float = ATTENDANCE_FLUSH_INTERVAL,
+                 batch_rows: int = ATTENDANCE_FLUSH_BATCH_ROWS):
+        self.path = path
+        self.interval = interval
+        self.batch_rows = batch_rows
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+        self.flushed_rows = 0
+        self.flush_errors = 0
+        self.failed_rows = 0
+        if path:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            conn = self._connection()
+            conn.executescript(_SCHEMA)
+            # Store tạo trước khi có cột sync_error
+            if "sync_error" not in {row[1] for row in conn.execute("PRAGMA table_info(absences)")}:
+                conn.execute("ALTER TABLE absences ADD COLUMN sync_error TEXT")
+            self._rekey_dates()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _connection(self) -> sqlite3.Connection:
+        # sqlite3.Connection không dùng chung được giữa các thread: mỗi thread (và mỗi process sau fork) mở kết nối riêng
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        # BEGIN IMMEDIATE lấy khóa ghi ngay từ đầu, tránh lỗi nâng cấp khóa khi nhiều process cùng ghi
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _rekey_dates(self):
+        """
+        date_key phụ thuộc SCHOOL_YEAR_START_MONTH: khi cấu hình đổi (hoặc store cũ chưa ghi lại tháng bắt đầu),
+        tính lại khóa cho từng ngày khác nhau để truy vấn theo khoảng ngày vẫn đúng.
+        """
+        with self._transaction() as conn:
+            row = conn.execute("SELECT value FROM store_meta WHERE key = 'school_year_start_month'").fetchone()
+            if row is not None and row[0] == str(SCHOOL_YEAR_START_MONTH):
+                return
+            dates = [value for value, in conn.execute("SELECT DISTINCT date FROM absences")]
+            conn.executemany("UPDATE absences SET date_key = ? WHERE date = ?",
+                             ((date_key(value), value) for value in dates))
+            conn.execute("INSERT OR REPLACE INTO store_meta (key, value) VALUES ('school_year_start_month', ?)",
+                         (str(SCHOOL_YEAR_START_MONTH),))
+
+    def add(self, spreadsheet_id: str, sheet_name: str, records: AbsenceRecords) -> int:
+        """
+        Commit bản ghi của một lô vào store (một transaction) và báo thread nền đồng bộ. Trả về số bản ghi đã lưu.
+        """
+        values = records.values
+        keys = [date_key(value) for value in values]
+        rows = ((spreadsheet_id, sheet_name, values[date_idx], keys[date_idx], values[name_idx],
+                 values[faculty_idx], values[class_idx], session)
+                for date_idx, name_idx, faculty_idx, class_idx, session in zip(
+                    records.dates, records.names, records.faculties, records.classes, records.sessions))
+        with self._transaction() as conn:
+            conn.executemany(
+                "INSERT INTO absences (spreadsheet_id, sheet_name, date, date_key, full_name, faculty, class_name, session) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self._wake.set()
+        return len(records)
+
+    def query(self, spreadsheet_id: str, sheet_name: str, date_from: Optional[str] = None,
+              date_to: Optional[str] = None, class_name: Optional[str] = None,
+              limit: int = ATTENDANCE_QUERY_LIMIT) -> dict:
+        """
+        Bản ghi của một sheet trong khoảng ngày [date_from, date_to] (dạng "dd/mm", bỏ trống = không giới hạn),
+        lọc theo lớp nếu có. Ngày được so sánh theo năm học (SCHOOL_YEAR_START_MONTH), ví dụ 15/12 tới 15/01. Dùng index (spreadsheet, sheet, ngày, lớp), không gọi Sheets API.
+        """
+        conditions = ["spreadsheet_id = ?", "sheet_name = ?"]
+        params: list = [spreadsheet_id, sheet_name]
+        for value, operator in ((date_from, ">="), (date_to, "<=")):
+            if value:
+                key = date_key(value)
+                if key is None:
+                    raise ValueError(f"Ngày không hợp lệ: {value}")
+                conditions.append(f"date_key {operator} ?")
+                params.append(key)
+        if class_name:
+            conditions.append("class_name = ?")
+            params.append(class_name)
+
+        cursor = self._connection().execute(
+            f"SELECT date, full_name, faculty, class_name, session, flushed, sync_error FROM absences "
+            f"WHERE {' AND '.join(conditions)} ORDER BY date_key IS NULL, date_key, class_name, id LIMIT ?", params + [limit + 1])
+        rows = cursor.fetchall()
+        records = []
+        for date_value, full_name, faculty, class_value, session, flushed, sync_error in rows[:limit]:
+            record = {"date": date_value, "fullName": full_name, "faculty": faculty, "className": class_value,
+                      "session": SESSIONS[session], "synced": flushed == SYNC_DONE, "syncState": SYNC_STATES[flushed]}
+            if sync_error:
+                record["syncError"] = sync_error
+            records.append(record)
+        return {"records": records, "count": len(records), "truncated": len(rows) > limit}
+
+    def pending_rows(self) -> int:
+        if not self.enabled:
+            return 0
+        return self._connection().execute("SELECT COUNT(*) FROM absences WHERE flushed = ?", (SYNC_PENDING,)).fetchone()[0]
+
+    def _claim_sheet(self, key: SheetKey, owner: str) -> Optional[int]:
+        """
+        Giữ quyền đồng bộ sheet cho process này. Trả về số lần đồng bộ lỗi liên tiếp trước đó,
+        None nếu worker khác đang giữ hoặc sheet đang chờ tới lượt thử lại.
+        Trạng thái nằm trong SQLite nên mọi worker cùng tôn trọng thời gian chờ thử lại.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT expires_at, failures FROM flush_leases WHERE spreadsheet_id = ? AND sheet_name = ?",
+                               key).fetchone()
+            if row is not None and row[0] > now:
+                return None
+            failures = row[1] if row is not None else 0
+            conn.execute("INSERT OR REPLACE INTO flush_leases (spreadsheet_id, sheet_name, owner, expires_at, failures) "
+                         "VALUES (?, ?, ?, ?, ?)", key + (owner, now + ATTENDANCE_LEASE_SECONDS, failures))
+        return failures
+
+    def _release_sheet(self, key: SheetKey, owner: str, failures: int):
+        with self._transaction() as conn:
+            if not failures:
+                conn.execute("DELETE FROM flush_leases WHERE spreadsheet_id = ? AND sheet_name = ? AND owner = ?",
+                             key + (owner,))
+                return
+            delay = min(ATTENDANCE_RETRY_MAX, self.interval * 2 ** failures)
+            conn.execute("UPDATE flush_leases SET owner = '', expires_at = ?, failures = ? "
+                         "WHERE spreadsheet_id = ? AND sheet_name = ? AND owner = ?",
+                         (time.time() + delay, failures) + key + (owner,))
+            logging.warning(f"Retrying sync of {key[0]}/{key[1]} in {delay:.1f}s")
+
+    def _pending_sheets(self) -> List[SheetKey]:
+        return [tuple(row) for row in self._connection().execute(
+            "SELECT DISTINCT spreadsheet_id, sheet_name FROM absences WHERE flushed = ?", (SYNC_PENDING,))]
+
+    def _mark(self, ids: List[int], state: int, error: Optional[str] = None):
+        with self._transaction() as conn:
+            conn.executemany("UPDATE absences SET flushed = ?, sync_error = ? WHERE id = ?",
+                             ((state, error, row_id) for row_id in ids))
+
+    def _flush_sheet(self, key: SheetKey) -> int:
+        """
+        Đồng bộ một lô bản ghi chưa đồng bộ của sheet. Trả về số bản ghi đã xử lý (đã ghi hoặc bị đánh dấu lỗi);
+        lỗi tạm thời (mạng, 429, 5xx) được ném ra để thử lại sau.
+        Mỗi chunk được đánh dấu đã đồng bộ ngay khi Sheets xác nhận, nên lần thử lại chỉ gửi các hàng chưa ghi.
+        """
+        spreadsheet_id, sheet_name = key
+        rows = self._connection().execute(
+            "SELECT id, date, full_name, faculty, class_name, session FROM absences "
+            "WHERE spreadsheet_id = ? AND sheet_name = ? AND flushed = ? ORDER BY id LIMIT ?",
+            key + (SYNC_PENDING, self.batch_rows)).fetchall()
+        if not rows:
+            return 0
+        ids = [row[0] for row in rows]
+        combined = [f"{ATTENDANCE} {session}" for session in SESSIONS]
+        sheet_rows = [["", date_value, "", full_name, faculty, class_name, "", combined[session]]
+                      for _, date_value, full_name, faculty, class_name, session in rows]
+
+        service = connect_to_google_sheets(spreadsheet_id)
+        if service is None:
+            raise RuntimeError("Không kết nối được Google Sheets")
+        marked = 0
+
+        def on_rows_written(written: int):
+            nonlocal marked
+            self._mark(ids[marked:written], SYNC_DONE)
+            with self._lock:
+                self.flushed_rows += written - marked
+            marked = written
+
+        try:
+            write_rows(sheet_rows, spreadsheet_id, sheet_name, service, on_rows_written=on_rows_written)
+        except Exception as e:
+            if not is_permanent_error(e):
+                raise
+            # Không có quyền, spreadsheet/sheet không tồn tại...: thử lại không giúp được, đánh dấu lỗi để báo người dùng
+            self._mark(ids[marked:], SYNC_FAILED, str(e))
+            with self._lock:
+                self.failed_rows += len(ids) - marked
+            logging.error(f"Sheets rejected {len(ids) - marked} stored rows for {spreadsheet_id}/{sheet_name}: {e}")
+            return len(ids)
+        logging.info(f"Synced {len(ids)} stored rows to {spreadsheet_id}/{sheet_name}")
+        return len(ids)
+
+    def flush(self) -> int:
+        """
+        Một lượt đồng bộ mọi sheet còn bản ghi chưa đồng bộ (bỏ qua sheet worker khác đang giữ hoặc đang chờ thử lại).
+        Trả về số bản ghi đã đồng bộ.
+        """
+        owner = str(os.getpid())
+        total = 0
+        for key in self._pending_sheets():
+            failures = self._claim_sheet(key, owner)
+            if failures is None:
+                continue
+            try:
+                while True:
+                    synced = self._flush_sheet(key)
+                    if not synced:
+                        break
+                    total += synced
+                    failures = 0
+            except Exception as e:
+                failures += 1
+                with self._lock:
+                    self.flush_errors += 1
+                logging.error(f"Attendance store sync of {key[0]}/{key[1]} failed: {e}")
+            finally:
+                self._release_sheet(key, owner, failures)
+        return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f"Attendance store flush failed: {e}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def start(self):
+        """
+        Khởi động thread đồng bộ nền (an toàn khi gọi lại, kể cả sau khi process bị fork). Không làm gì nếu store tắt.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._stop.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="attendance-flusher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+attendance_store = AttendanceStore()
+if attendance_store.enabled:
+    registry.gauge_callback("attendance_store_pending_rows", "Số bản ghi trong store chưa đồng bộ lên Google Sheets",
+                            attendance_store.pending_rows)
+    registry.gauge_callback("attendance_store_synced_rows", "Số hàng thread nền đã đồng bộ lên Google Sheets",
+                            lambda: attendance_store.flushed_rows)
+    registry.gauge_callback("attendance_store_sync_errors", "Số lần đồng bộ một sheet bị lỗi tạm thời (sẽ thử lại)",
+                            lambda: attendance_store.flush_errors)
+    registry.gauge_callback("attendance_store_failed_rows", "Số bản ghi Google Sheets từ chối (không có quyền, sai sheet...)",
+                            lambda: attendance_store.failed_rows)
@@ -0,0 +1,201 @@
+"""
+Benchmark các bước xử lý file điểm danh trên workbook tổng hợp (không cần file thật hay Google Sheets).
+
+Ví dụ:
+    python benchmark.py --output bench.json
+    python benchmark.py --students 30 500 --groups 1 50 --density 0.1 --repeat 5 --compare bench.json
+"""
+import os
+# Tắt giới hạn tốc độ gọi API cho service giả lập (phải đặt trước khi import sheets_writer)
+os.environ.setdefault('SHEETS_REQUESTS_PER_SECOND', '0')
+
+import io
+import re
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import statistics
+from typing import Dict, List
+
+import openpyxl
+
+from pipeline import process_uploaded_file
+from uploadGgSheet import upload_to_google_sheets
+
+DEFAULT_STUDENTS = [30, 200, 2000]
+DEFAULT_GROUPS = [1, 20, 200]
+DEFAULT_DENSITY = 0.05
+# Mức chậm đi (tỉ lệ so với baseline) bị coi là hồi quy khi dùng --compare
+REGRESSION_THRESHOLD = 1.2
+
+def make_workbook(students: int, groups: int, density: float, seed: int = 0) -> bytes:
+    """
+    Tạo file .xlsx theo đúng bố cục summarize_k_attendance cần: hàng 1 là ngày "dd/mm" từ cột 7
+    theo nhóm 4 cột, hàng 2 là C1-C4, từ hàng 3 họ đệm ở cột C, tên ở cột D và "K" với mật độ density.
+    """
+    rnd = random.Random(seed)
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet("Sheet")
+
+    dates = [f"{day % 28 + 1:02d}/{day // 28 % 12 + 1:02d}" for day in range(groups)]
+    header = ["STT", "Mã HSSV", "Họ đệm", "Tên", "Ngày sinh", "Ghi chú"]
+    sheet.append(header + [value for date in dates for value in (date, None, None, None)])
+    sheet.append([None] * len(header) + [f"C{offset + 1}" for _ in dates for offset in range(4)])
+    for student in range(students):
+        marks = ["K" if rnd.random() < density else None for _ in range(groups * 4)]
+        sheet.append([student + 1, f"HS{student:05d}", "Nguyễn Văn", f"An {student}", None, None] + marks)
+
+    buffer = io.BytesIO()
+    workbook.save(buffer)
+    return buffer.getvalue()
+
+class _Request:
+    def __init__(self, result):
+        self._result = result
+
+    def execute(self):
+        return self._result
+
+class _FakeValues:
+    """
+    Sheets values() giả lập trong bộ nhớ: đủ get/append/update cho SheetsWriter, không gọi mạng.
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.calls = 0
+
+    def get(self, spreadsheetId, range):
+        self.calls += 1
+        return _Request({})
+
+    def append(self, spreadsheetId, range, valueInputOption, insertDataOption, body):
+        self.calls += 1
+        start = self.rows + 1
+        self.rows += len(body["values"])
+        sheet_name = range.split('!')[0]
+        return _Request({"updates": {"updatedRange": f"{sheet_name}!A{start}:H{self.rows}"}})
+
+    def update(self, spreadsheetId, range, valueInputOption, body):
+        self.calls += 1
+        end_row = int(re.search(r':[A-Z]+(\d+)$', range).group(1))
+        self.rows = max(self.rows, end_row)
+        return _Request({"updatedRange": range})
+
+class FakeSheetsService:
+    def __init__(self):
+        self._values = _FakeValues()
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self._values
+
+def run_case(data: bytes, faculty_name: str = "Khoa Benchmark", filename: str = "BENCH.xlsx") -> Dict[str, float]:
+    """
+    Chạy các bước đã đăng ký của pipeline cho một file rồi ánh xạ A-H và upload lên service giả lập.
+    Trả về thời gian (giây) từng bước và số hàng nghỉ học.
+    """
+    result = process_uploaded_file(filename, data, faculty_name)
+    if result.error:
+        raise RuntimeError(f"Workbook tổng hợp không hợp lệ: {result.error}")
+    timings: Dict[str, float] = dict(result.timings)
+
+    def timed(stage, func, *args):
+        start = time.perf_counter()
+        value = func(*args)
+        timings[stage] = time.perf_counter() - start
+        return value
+
+    rows = timed("map_rows", result.records.to_sheet_rows)
+    if not timed("upload", upload_to_google_sheets, rows, "benchmark", "Bao_cao", FakeSheetsService()):
+        raise RuntimeError("Upload lên service giả lập thất bại")
+    timings["rows"] = len(rows)
+    return timings
+
+def benchmark(students_list: List[int], groups_list: List[int], density: float, repeat: int) -> List[dict]:
+    results = []
+    for students in students_list:
+        for groups in groups_list:
+            data = make_workbook(students, groups, density)
+            runs = [run_case(data) for _ in range(repeat)]
+            stages = [stage for stage in runs[0] if stage != "rows"]
+            total = [sum(run[stage] for stage in stages) for run in runs]
+            case = {
+                "students": students,
+                "groups": groups,
+                "density": density,
+                "fileBytes": len(data),
+                "rows": runs[0]["rows"],
+                # Lấy giá trị nhỏ nhất và trung vị qua các lần lặp (ms) để giảm nhiễu
+                "stagesMs": {stage: {"min": round(min(run[stage] for run in runs) * 1000, 3),
+                                     "median": round(statistics.median(run[stage] for run in runs) * 1000, 3)}
+                             for stage in stages},
+                "totalMs": {"min": round(min(total) * 1000, 3), "median": round(statistics.median(total) * 1000, 3)},
+            }
+            case["rowsPerSecond"] = round(case["rows"] / min(total), 1) if min(total) > 0 else 0.0
+            print(f"{students} students x {groups} groups: {case['totalMs']['median']:.1f} ms, {case['rows']} rows", file=sys.stderr)
+            results.append(case)
+    return results
+
+def compare(results: List[dict], baseline: dict, threshold: float = REGRESSION_THRESHOLD) -> List[str]:
+    """
+    So sánh với file JSON của lần chạy trước, trả về danh sách các bước chậm đi quá threshold lần (theo min).
+    """
+    previous = {(case["students"], case["groups"], case["density"]): case for case in baseline.get("results", [])}
+    regressions = []
+    for case in results:
+        old = previous.get((case["students"], case["groups"], case["density"]))
+        if old is None:
+            continue
+        for stage in list(case["stagesMs"]) + ["total"]:
+            new_ms = case["totalMs"]["min"] if stage == "total" else case["stagesMs"][stage]["min"]
+            old_ms = old["totalMs"]["min"] if stage == "total" else old["stagesMs"].get(stage, {}).get("min")
+            if old_ms and new_ms / old_ms > threshold:
+                regressions.append(f"{case['students']}x{case['groups']} {stage}: {old_ms:.1f} -> {new_ms:.1f} ms "
+                                   f"({new_ms / old_ms:.2f}x)")
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark xử lý file điểm danh với workbook tổng hợp")
+    parser.add_argument("--students", type=int, nargs="+", default=DEFAULT_STUDENTS, help="Sĩ số lớp (30-2000)")
+    parser.add_argument("--groups", type=int, nargs="+", default=DEFAULT_GROUPS, help="Số nhóm ngày (1-200)")
+    parser.add_argument("--density", type=float, default=DEFAULT_DENSITY, help="Tỉ lệ ô 'K'")
+    parser.add_argument("--repeat", type=int, default=3, help="Số lần lặp mỗi trường hợp")
+    parser.add_argument("--output", help="Ghi kết quả JSON ra file (mặc định in ra stdout)")
+    parser.add_argument("--compare", help="File JSON của lần chạy trước để phát hiện hồi quy")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    # Log DEBUG của các bước làm sai lệch số đo
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = {
+        "createdAt": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "openpyxl": openpyxl.__version__,
+        "repeat": args.repeat,
+        "results": benchmark(args.students, args.groups, args.density, args.repeat),
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(report["results"], json.load(f), args.threshold)
+        for line in regressions:
+            logging.error(f"Regression: {line}")
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+import os
+import hashlib
+import tempfile
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows: chỉ khóa giữa các thread trong process
+    fcntl = None
+
+# Thư mục file khóa/trạng thái dùng chung giữa các worker process (gunicorn nhiều worker) khi ghi Google Sheets.
+# Mọi process ghi cùng spreadsheet phải dùng cùng một thư mục (mặc định trong thư mục tạm của máy)
+SHEETS_STATE_DIR = os.getenv('SHEETS_STATE_DIR', os.path.join(tempfile.gettempdir(), 'sheets-state'))
+
+os.makedirs(SHEETS_STATE_DIR, exist_ok=True)
+
+def state_path(*parts: str, suffix: str = '.lock') -> str:
+    """
+    Đường dẫn file trong SHEETS_STATE_DIR cho một khóa bất kỳ (ví dụ spreadsheet + tên sheet).
+    """
+    digest = hashlib.sha1('\0'.join(parts).encode('utf-8')).hexdigest()
+    return os.path.join(SHEETS_STATE_DIR, f"{digest}{suffix}")
+
+class FileLock:
+    """
+    Lock loại trừ giữa các thread (RLock, cho phép cùng thread lấy lồng nhau) và giữa các process (flock trên file).
+    flock chỉ được lấy ở lần acquire ngoài cùng và nhả khi lần release cuối cùng.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def acquire(self):
+        self._lock.acquire()
+        if self._depth == 0 and fcntl is not None:
+            try:
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                except BaseException:
+                    os.close(fd)
+                    raise
+            except BaseException:
+                self._lock.release()
+                raise
+            self._fd = fd
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0 and self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
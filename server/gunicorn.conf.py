@@ -0,0 +1,34 @@
+# Cấu hình gunicorn cho production: cd server && gunicorn -c gunicorn.conf.py
+import os
+import tempfile
+import multiprocessing
+
+# Thread nền (warm-up, kiểm tra mạng) không tồn tại qua fork: chỉ khởi động trong worker (post_fork)
+os.environ.setdefault('APP_DEFER_BACKGROUND', '1')
+# Các worker dùng chung trạng thái job để /jobs/<id> trả đúng dù request poll rơi vào worker nào
+os.environ.setdefault('JOB_STATE_DIR', os.path.join(tempfile.gettempdir(), 'upload-jobs'))
+# Lock theo sheet, generation của index diff và token bucket của Sheets API nằm trong SHEETS_STATE_DIR
+# (mặc định <tmp>/sheets-state): mọi worker phải thấy cùng thư mục để ghi tuần tự và giới hạn tốc độ chung
+os.environ.setdefault('SHEETS_STATE_DIR', os.path.join(tempfile.gettempdir(), 'sheets-state'))
+
+wsgi_app = 'wsgi:application'
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+# Số worker process (WEB_CONCURRENCY theo quy ước của Render/Heroku)
+workers = int(os.getenv('WEB_CONCURRENCY', str(min(4, multiprocessing.cpu_count() * 2 + 1))))
+# gthread: mỗi worker phục vụ nhiều request poll/upload song song trong khi job chạy ở thread nền
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+# Import app (openpyxl, googleapiclient...) một lần trong master, worker dùng chung bộ nhớ qua copy-on-write
+preload_app = True
+loglevel = os.getenv('LOG_LEVEL', 'info').lower()
+accesslog = '-' if os.getenv('GUNICORN_ACCESS_LOG', '0').lower() in ('1', 'true', 'yes') else None
+
+def when_ready(server):
+    # Tải credentials và build Sheets service trong master trước khi fork worker
+    from uploadGgSheet import warm_up_google_sheets
+    warm_up_google_sheets()
+
+def post_fork(server, worker):
+    from app import start_background_tasks
+    start_background_tasks()
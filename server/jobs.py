@@ -0,0 +1,182 @@
+import os
+import re
+import json
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from pipeline import FileResult, Upload, aggregate_batch, process_batch, release_uploads
+from metrics import RequestMetrics
+
+# Số job /process chạy nền đồng thời
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+# Số job tối đa đang chờ/chạy, vượt quá thì từ chối để tránh giữ quá nhiều file trong bộ nhớ
+MAX_PENDING_JOBS = int(os.getenv('MAX_PENDING_JOBS', '20'))
+# Thời gian giữ kết quả job đã xong để client poll
+JOB_TTL_SECONDS = int(os.getenv('JOB_TTL_SECONDS', '3600'))
+# Thư mục chia sẻ trạng thái job giữa các worker process (gunicorn nhiều worker): client poll /jobs/<id>
+# có thể rơi vào worker khác worker đã nhận file. Để trống = chỉ giữ trong bộ nhớ của process
+JOB_STATE_DIR = os.getenv('JOB_STATE_DIR', '')
+
+if JOB_STATE_DIR:
+    os.makedirs(JOB_STATE_DIR, exist_ok=True)
+
+class Job:
+    def __init__(self, filenames: List[str]):
+        self.id = uuid.uuid4().hex
+        self.state = "queued"  # queued -> running -> uploading -> done | failed
+        self.files = [{"name": name, "state": "queued"} for name in filenames]
+        self.result: Optional[dict] = None
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    def is_active(self) -> bool:
+        return self.state not in ("done", "failed")
+
+    def to_dict(self) -> dict:
+        processed = sum(1 for f in self.files if f["state"] in ("done", "error"))
+        data = {
+            "jobId": self.id,
+            "state": self.state,
+            "files": [dict(f) for f in self.files],
+            "processedFiles": processed,
+            "totalFiles": len(self.files),
+        }
+        if self.result is not None:
+            data["result"] = self.result
+        return data
+
+_jobs: Dict[str, Job] = {}
+_jobs_lock = threading.Lock()
+_executor: Optional[ThreadPoolExecutor] = None
+
+def _get_executor() -> ThreadPoolExecutor:
+    # Tạo lười để thread chỉ được khởi động trong process phục vụ request
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+    return _executor
+
+def _state_path(job_id: str) -> str:
+    return os.path.join(JOB_STATE_DIR, f"{job_id}.json")
+
+def _publish(job: Job):
+    # Ghi trạng thái job ra JOB_STATE_DIR cho các worker khác; gọi khi đang giữ _jobs_lock
+    if not JOB_STATE_DIR:
+        return
+    try:
+        tmp_path = f"{_state_path(job.id)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(job.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_path, _state_path(job.id))
+    except Exception as e:
+        logging.warning(f"Error writing state of job {job.id}: {e}")
+
+def _read_published(job_id: str) -> Optional[dict]:
+    # job_id đến từ URL: chỉ chấp nhận đúng dạng uuid hex để không đọc file ngoài thư mục
+    if not JOB_STATE_DIR or not re.fullmatch(r'[0-9a-f]{32}', job_id):
+        return None
+    path = _state_path(job_id)
+    try:
+        if time.time() - os.path.getmtime(path) > JOB_TTL_SECONDS:
+            os.remove(path)
+            return None
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning(f"Error reading state of job {job_id}: {e}")
+        return None
+
+def _purge_expired(now: float):
+    expired = [job_id for job_id, job in _jobs.items()
+               if job.finished_at is not None and now - job.finished_at > JOB_TTL_SECONDS]
+    for job_id in expired:
+        del _jobs[job_id]
+        if JOB_STATE_DIR:
+            try:
+                os.remove(_state_path(job_id))
+            except FileNotFoundError:
+                pass
+
+def _run_job(job: Job, uploads: List[Upload], faculty_name: str, spreadsheet_id: str, sheet_name: str, service,
+             diff: bool, metrics: RequestMetrics, include_timings: bool, queued_at: float, aggregate: bool,
+             summary_sheet_name: Optional[str]):
+    metrics.add_stage("queue_wait", time.perf_counter() - queued_at)
+
+    def on_file_done(index: int, result: FileResult):
+        with _jobs_lock:
+            file_state = job.files[index]
+            if result.error:
+                file_state.update(state="error", error=result.error)
+                if result.issues:
+                    file_state["issues"] = result.issues
+            else:
+                file_state.update(state="done", rows=len(result.records))
+            if all(f["state"] in ("done", "error") for f in job.files):
+                job.state = "uploading"
+            _publish(job)
+
+    with _jobs_lock:
+        job.state = "running"
+        for file_state in job.files:
+            file_state["state"] = "processing"
+        _publish(job)
+    try:
+        if aggregate:
+            result = aggregate_batch(uploads, faculty_name, spreadsheet_id, sheet_name, service, on_file_done, metrics,
+                                     summary_sheet_name)
+        else:
+            result = process_batch(uploads, faculty_name, spreadsheet_id, sheet_name, service, on_file_done, diff, metrics)
+        state = "done"
+    except Exception as e:
+        logging.error(f"Job {job.id} failed: {e}")
+        result = {"status": f"Lỗi: {str(e)}", "error": True}
+        state = "failed"
+    finally:
+        # Giải phóng nội dung file (và file tạm của chế độ streaming) ngay khi xử lý xong
+        release_uploads(uploads)
+
+    if include_timings:
+        result["timings"] = metrics.to_dict()
+    with _jobs_lock:
+        job.result = result
+        job.state = state
+        job.finished_at = time.time()
+        _publish(job)
+
+def submit_job(uploads: List[Upload], faculty_name: str, spreadsheet_id: str, sheet_name: str, service,
+               diff: bool = False, metrics: Optional[RequestMetrics] = None,
+               include_timings: bool = False, aggregate: bool = False,
+               summary_sheet_name: Optional[str] = None) -> Optional[Job]:
+    """
+    Lưu các file upload vào job mới và đưa vào hàng đợi xử lý nền.
+    include_timings=True đưa thời gian từng bước vào kết quả job (result["timings"]).
+    aggregate=True chỉ ghi tab thống kê (summary_sheet_name) thay vì các hàng chi tiết.
+    Trả về None nếu hàng đợi đã đầy.
+    """
+    metrics = metrics if metrics is not None else RequestMetrics()
+    job = Job([filename for filename, _ in uploads])
+    with _jobs_lock:
+        _purge_expired(time.time())
+        if sum(1 for j in _jobs.values() if j.is_active()) >= MAX_PENDING_JOBS:
+            logging.warning("Job queue is full, rejecting request")
+            return None
+        _jobs[job.id] = job
+        _publish(job)
+    _get_executor().submit(_run_job, job, list(uploads), faculty_name, spreadsheet_id, sheet_name, service, diff,
+                           metrics, include_timings, time.perf_counter(), aggregate, summary_sheet_name)
+    logging.info(f"Queued job {job.id} with {len(uploads)} files")
+    return job
+
+def get_job_status(job_id: str) -> Optional[dict]:
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+    # Job do worker process khác nhận
+    return _read_published(job_id)
@@ -0,0 +1,322 @@
+"""
+Load test /process qua gunicorn với số worker khác nhau, dùng Sheets API giả lập cục bộ (không gọi Google).
+
+Ví dụ:
+    python load_test.py --workers 1 2 4 --requests 40 --concurrency 8 --output load.json
+
+Mỗi request upload một workbook tổng hợp (benchmark.make_workbook) rồi poll /jobs/<id> tới khi xong;
+thông lượng là số request hoàn tất mỗi giây. Cần gunicorn và cryptography (tạo khóa service account giả).
+
+    python load_test.py --check-writers
+
+chỉ kiểm tra ghi đồng thời: nhiều process (mỗi process 2 thread) cùng upload_to_google_sheets vào một sheet
+của server giả lập với chunk nhỏ; mọi hàng phải có mặt, đúng một hàng header, không có hàng trống
+và hàng của mỗi lô nằm liền nhau.
+"""
+import os
+import re
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import statistics
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import unquote, urlparse
+
+import requests
+
+from benchmark import make_workbook
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def _parse_range(range_name: str) -> Tuple[str, int, Optional[int]]:
+    # "Sheet!A5:H9" -> ("Sheet", 5, 9); "Sheet!A:H" -> ("Sheet", 1, None); "Sheet" -> ("Sheet", 1, None)
+    sheet, _, cells = range_name.partition('!')
+    match = re.fullmatch(r'[A-Z]*(\d*)(?::[A-Z]*(\d*))?', cells)
+    start = int(match.group(1)) if match and match.group(1) else 1
+    end = int(match.group(2)) if match and match.group(2) else None
+    return sheet, start, end
+
+class _FakeSheetsHandler(BaseHTTPRequestHandler):
+    """
+    Sheets API giả lập cho luồng /process: cấp token OAuth, values.get, values.append (nối vào cuối bảng),
+    values.update, spreadsheets.get và batchUpdate (thêm/xóa hàng). Giá trị được giữ trong bộ nhớ theo tên sheet
+    để kiểm tra nội dung sau khi ghi; sheetId là thứ tự tạo sheet, lưới có đúng số hàng đang lưu.
+    """
+    protocol_version = 'HTTP/1.1'
+    sheets: Dict[str, List[list]] = {}
+    lock = threading.Lock()
+    # Độ trễ giả lập mỗi lần append, đủ để các lần ghi đồng thời chen vào nhau nếu không được khóa
+    append_delay = 0.01
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body: dict):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _read_body(self) -> dict:
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        # Request lấy token gửi dạng form, request Sheets API gửi JSON
+        if body and 'json' in self.headers.get('Content-Type', ''):
+            return json.loads(body)
+        return {}
+
+    def do_GET(self):
+        path = unquote(urlparse(self.path).path)
+        if '/values/' not in path:
+            with self.lock:
+                sheets = [{"properties": {"sheetId": index, "title": title, "gridProperties": {"rowCount": len(rows)}}}
+                          for index, (title, rows) in enumerate(self.sheets.items())]
+            return self._send({"sheets": sheets})
+        sheet, start, end = _parse_range(path.rsplit('/values/', 1)[-1])
+        with self.lock:
+            rows = self.sheets.get(sheet, [])
+            values = rows[start - 1:end] if end is not None else rows[start - 1:]
+        self._send({"values": values} if values else {})
+
+    def do_POST(self):
+        path = unquote(urlparse(self.path).path)
+        body = self._read_body()
+        if path == '/token':
+            return self._send({"access_token": "load-test", "expires_in": 3600, "token_type": "Bearer"})
+        if path.endswith(':append'):
+            sheet, _, _ = _parse_range(path.rsplit('/values/', 1)[-1][:-len(':append')])
+            # Sheets ghi vào sau hàng cuối của bảng tại thời điểm nhận request
+            with self.lock:
+                rows = self.sheets.setdefault(sheet, [])
+                start = len(rows) + 1
+            time.sleep(self.append_delay)
+            with self.lock:
+                rows = self.sheets[sheet]
+                rows[start - 1:start - 1 + len(body.get("values", []))] = body.get("values", [])
+                end = start + len(body.get("values", [])) - 1
+            return self._send({"updates": {"updatedRange": f"{sheet}!A{start}:H{end}"}})
+        if path.endswith(':batchUpdate'):
+            with self.lock:
+                for request in body.get("requests", []):
+                    self._apply(request)
+            return self._send({})
+        self._send({})
+
+    def _apply(self, request: dict):
+        # Các request batchUpdate mà SheetsWriter dùng để giữ chỗ/trả lại hàng
+        titles = list(self.sheets)
+        if "appendDimension" in request:
+            rows = self.sheets[titles[request["appendDimension"]["sheetId"]]]
+            rows.extend([] for _ in range(request["appendDimension"]["length"]))
+        elif "insertDimension" in request:
+            target = request["insertDimension"]["range"]
+            rows = self.sheets[titles[target["sheetId"]]]
+            rows[target["startIndex"]:target["startIndex"]] = [[] for _ in range(target["endIndex"] - target["startIndex"])]
+        elif "deleteDimension" in request:
+            target = request["deleteDimension"]["range"]
+            del self.sheets[titles[target["sheetId"]]][target["startIndex"]:target["endIndex"]]
+
+    def do_PUT(self):
+        path = unquote(urlparse(self.path).path)
+        range_name = path.rsplit('/values/', 1)[-1]
+        values = self._read_body().get("values", [])
+        sheet, start, _ = _parse_range(range_name)
+        with self.lock:
+            rows = self.sheets.setdefault(sheet, [])
+            rows.extend([] for _ in range(start - 1 + len(values) - len(rows)))
+            rows[start - 1:start - 1 + len(values)] = values
+        self._send({"updatedRange": range_name})
+
+def _service_account_json(token_uri: str) -> str:
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                            serialization.NoEncryption()).decode('ascii')
+    return json.dumps({"type": "service_account", "project_id": "load-test", "private_key_id": "load-test",
+                       "private_key": pem, "client_email": "load-test@load-test.iam.gserviceaccount.com",
+                       "client_id": "0", "token_uri": token_uri})
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def _wait_ready(base_url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"{base_url}/", timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server at {base_url} did not start")
+
+def _run_request(base_url: str, data: bytes, index: int) -> float:
+    start = time.perf_counter()
+    response = requests.post(f"{base_url}/process", data={
+        "googleSheetUrl": "https://docs.google.com/spreadsheets/d/load-test/edit",
+        "sheetName": "Bao_cao",
+        "faculty": "Khoa Y dược",
+    }, files=[("files", (f"LT{index}.xlsx", data))], timeout=60).json()
+    if response.get("error"):
+        raise RuntimeError(response.get("status"))
+    while True:
+        status = requests.get(f"{base_url}/jobs/{response['jobId']}", timeout=60).json()
+        if status.get("error"):
+            raise RuntimeError(status.get("status"))
+        if "result" in status:
+            if status["result"].get("error") or status["result"].get("errors"):
+                raise RuntimeError(status["result"])
+            return time.perf_counter() - start
+        time.sleep(0.05)
+
+def run_load(workers: int, total: int, concurrency: int, data: bytes, env: dict) -> dict:
+    port = _free_port()
+    base_url = f"http://127.0.0.1:{port}"
+    server = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py"], cwd=SERVER_DIR,
+                              env=dict(env, WEB_CONCURRENCY=str(workers), PORT=str(port)))
+    try:
+        _wait_ready(base_url)
+        latencies, errors = [], []
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = [executor.submit(_run_request, base_url, data, index) for index in range(total)]
+            for future in futures:
+                try:
+                    latencies.append(future.result())
+                except Exception as e:
+                    errors.append(str(e))
+        elapsed = time.perf_counter() - start
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+    latencies.sort()
+    return {
+        "workers": workers,
+        "requests": total,
+        "concurrency": concurrency,
+        "seconds": round(elapsed, 3),
+        "requestsPerSecond": round(len(latencies) / elapsed, 2) if elapsed > 0 else 0.0,
+        "latencyMs": {
+            "p50": round(statistics.median(latencies) * 1000, 1) if latencies else None,
+            "p95": round(latencies[int(0.95 * (len(latencies) - 1))] * 1000, 1) if latencies else None,
+            "max": round(latencies[-1] * 1000, 1) if latencies else None,
+        },
+        "errors": errors[:10],
+        "errorCount": len(errors),
+    }
+
+# 23 hàng, chunk 5: ghi theo đường song song (append chunk đầu, giữ chỗ, update các chunk còn lại)
+WRITER_ROWS = 23
+WRITER_CHUNK_ROWS = 5
+
+def _write_rows(prefix: str) -> List[bool]:
+    # Chạy trong process con (spawn): env trỏ tới server giả lập đã được đặt trước khi tạo process
+    from uploadGgSheet import connect_to_google_sheets, upload_to_google_sheets
+
+    service = connect_to_google_sheets('load-test')
+
+    def write(batch: str) -> bool:
+        rows = [["", "01/09", "", f"{batch}-{i}", "Khoa", "L", "", "Nghỉ học Buổi sáng"] for i in range(WRITER_ROWS)]
+        return upload_to_google_sheets(rows, 'load-test', 'Check', service, chunk_size=WRITER_CHUNK_ROWS)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        return list(executor.map(write, [f"{prefix}a", f"{prefix}b"]))
+
+def check_concurrent_writers(env: dict, processes: int = 2) -> dict:
+    """
+    Nhiều process x 2 thread cùng ghi một sheet của server giả lập. Kiểm tra không mất hàng, đúng một header,
+    không có hàng trống và hàng của mỗi lô liền nhau, đúng thứ tự.
+    """
+    os.environ.update(env, SHEETS_STATE_DIR=tempfile.mkdtemp(prefix='load-test-locks-'))
+    _FakeSheetsHandler.sheets.pop('Check', None)
+    with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn')) as executor:
+        results = [ok for batch in executor.map(_write_rows, [f"P{index}" for index in range(processes)]) for ok in batch]
+
+    rows = _FakeSheetsHandler.sheets.get('Check', [])
+    names = [row[3] for row in rows if len(row) > 3 and row[1] != "Ngày"]
+    batches = [f"P{index}{thread}" for index in range(processes) for thread in "ab"]
+    expected = [f"{batch}-{i}" for batch in batches for i in range(WRITER_ROWS)]
+    contiguous = all(names[names.index(f"{batch}-0"):names.index(f"{batch}-0") + WRITER_ROWS]
+                     == [f"{batch}-{i}" for i in range(WRITER_ROWS)]
+                     for batch in batches if f"{batch}-0" in names)
+    report = {
+        "writers": len(batches),
+        "rowsSent": len(expected),
+        "rowsOnSheet": len(names),
+        "headerRows": sum(1 for row in rows if len(row) > 1 and row[1] == "Ngày"),
+        # Hàng trống giữa bảng: chỗ đã giữ nhưng không được ghi
+        "blankRows": sum(1 for row in rows if not any(row)),
+        "missingRows": sorted(set(expected) - set(names)),
+        "contiguous": contiguous,
+        "uploadsSucceeded": all(results),
+    }
+    report["ok"] = (report["uploadsSucceeded"] and not report["missingRows"] and report["rowsOnSheet"] == len(expected)
+                    and report["headerRows"] == 1 and not report["blankRows"] and contiguous)
+    return report
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Load test /process với số gunicorn worker khác nhau")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="Các số worker cần đo")
+    parser.add_argument("--requests", type=int, default=40, help="Tổng số request mỗi lần đo")
+    parser.add_argument("--concurrency", type=int, default=8, help="Số client gửi đồng thời")
+    parser.add_argument("--students", type=int, default=200)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--density", type=float, default=0.05)
+    parser.add_argument("--check-writers", action="store_true",
+                        help="Chỉ kiểm tra nhiều process/thread ghi cùng một sheet không mất hàng")
+    parser.add_argument("--output", help="Ghi kết quả JSON ra file (mặc định in ra stdout)")
+    args = parser.parse_args(argv)
+
+    fake = ThreadingHTTPServer(('127.0.0.1', 0), _FakeSheetsHandler)
+    threading.Thread(target=fake.serve_forever, daemon=True).start()
+    fake_url = f"http://127.0.0.1:{fake.server_address[1]}"
+
+    env = dict(os.environ,
+               GOOGLE_CREDENTIALS=_service_account_json(f"{fake_url}/token"),
+               SHEETS_API_ENDPOINT=fake_url,
+               SHEETS_REQUESTS_PER_SECOND='0',
+               # Tắt cache kết quả để mọi request đều parse file thật
+               RESULT_CACHE_MAX_ENTRIES='0',
+               RESULT_CACHE_DIR='',
+               JOB_STATE_DIR=tempfile.mkdtemp(prefix='load-test-jobs-'),
+               MAX_PENDING_JOBS=str(max(20, args.requests)),
+               LOG_LEVEL=os.getenv('LOG_LEVEL', 'WARNING'))
+
+    if args.check_writers:
+        report = check_concurrent_writers(env)
+        fake.shutdown()
+        print(json.dumps(report, indent=2))
+        return 0 if report["ok"] else 1
+
+    data = make_workbook(args.students, args.groups, args.density)
+    results = []
+    for workers in args.workers:
+        result = run_load(workers, args.requests, args.concurrency, data, env)
+        print(f"{workers} workers: {result['requestsPerSecond']} req/s, p50 {result['latencyMs']['p50']} ms, "
+              f"{result['errorCount']} errors", file=sys.stderr)
+        results.append(result)
+    fake.shutdown()
+
+    output = json.dumps({"cpuCount": os.cpu_count(), "fileBytes": len(data), "results": results}, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+    return 0 if all(result["errorCount"] == 0 for result in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
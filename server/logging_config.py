@@ -0,0 +1,16 @@
+import os
+import logging
+
+# Mức log của server (DEBUG, INFO, WARNING...); mặc định INFO
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# Log từng ô "K" khi thống kê (rất nhiều dòng mỗi file), chỉ bật khi cần gỡ lỗi một file cụ thể
+LOG_CELLS = os.getenv('LOG_CELLS', '0').lower() in ('1', 'true', 'yes')
+
+# Logger riêng cho log trong vòng lặp nóng, tắt mặc định kể cả khi LOG_LEVEL=DEBUG
+CELL_LOGGER = 'attendance.cells'
+
+def configure_logging():
+    # force=True: các lời gọi logging.* lúc import (trước khi cấu hình) đã tự tạo handler mặc định
+    logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s',
+                        force=True)
+    logging.getLogger(CELL_LOGGER).setLevel(logging.DEBUG if LOG_CELLS else logging.WARNING)
@@ -0,0 +1,221 @@
+import sys
+import time
+import threading
+import contextvars
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Mốc bucket (giây) cho histogram thời gian
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+LabelSet = Tuple[Tuple[str, str], ...]
+
+def peak_rss_bytes() -> int:
+    """
+    RSS lớn nhất của process từ lúc khởi động (0 nếu hệ điều hành không hỗ trợ).
+    """
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS trả về byte, Linux trả về KB
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class RequestMetrics:
+    """
+    Số liệu của một lần xử lý /process: thời gian từng bước, số byte đã parse, số hàng, số lần gọi Sheets API.
+    Thời gian các bước theo file được cộng dồn (khi chạy song song có thể lớn hơn tổng thời gian thực).
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, float] = defaultdict(float)
+        self.api_calls: Dict[str, int] = defaultdict(int)
+        self.bytes_parsed = 0
+        self.rows = 0
+        self.files = 0
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_stage(self, name: str, seconds: float):
+        with self._lock:
+            self.stages[name] += seconds
+
+    def merge_stages(self, stages: Dict[str, float]):
+        with self._lock:
+            for name, seconds in stages.items():
+                self.stages[name] += seconds
+
+    def count_api_call(self, method: str):
+        with self._lock:
+            self.api_calls[method] += 1
+
+    def finish(self):
+        if self.finished is None:
+            self.finished = time.perf_counter()
+
+    @property
+    def total_seconds(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    def to_dict(self) -> dict:
+        total = self.total_seconds
+        with self._lock:
+            return {
+                "stagesMs": {name: round(seconds * 1000, 3) for name, seconds in self.stages.items()},
+                "totalMs": round(total * 1000, 3),
+                "files": self.files,
+                "rows": self.rows,
+                "rowsPerSecond": round(self.rows / total, 1) if total > 0 else 0.0,
+                "bytesParsed": self.bytes_parsed,
+                "apiCalls": dict(self.api_calls),
+                "peakRssBytes": peak_rss_bytes(),
+            }
+
+class StageTimer:
+    """
+    Đo thời gian các bước của một file (chạy được trong process con, kết quả là dict thường để pickle).
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+# Số liệu của request đang chạy trong thread/context hiện tại (để đếm lời gọi API ở tầng thấp)
+current_metrics: contextvars.ContextVar[Optional[RequestMetrics]] = contextvars.ContextVar('current_metrics', default=None)
+
+def _escape_label(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class MetricsRegistry:
+    """
+    Số liệu cộng dồn của cả process, xuất ra định dạng text của Prometheus.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help: Dict[str, Tuple[str, str]] = {}
+        self._counters: Dict[str, Dict[LabelSet, float]] = defaultdict(dict)
+        self._gauges: Dict[str, Dict[LabelSet, float]] = defaultdict(dict)
+        self._histograms: Dict[str, Dict[LabelSet, List]] = defaultdict(dict)
+        self._callbacks: List[Tuple[str, str, Callable[[], float]]] = []
+
+    def describe(self, name: str, metric_type: str, help_text: str):
+        self._help[name] = (metric_type, help_text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        with self._lock:
+            self._gauges[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name: str, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms[name].get(key)
+            if series is None:
+                series = self._histograms[name][key] = [[0] * len(DURATION_BUCKETS), 0.0, 0]
+            index = bisect_left(DURATION_BUCKETS, value)
+            if index < len(DURATION_BUCKETS):
+                series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def gauge_callback(self, name: str, help_text: str, callback: Callable[[], float]):
+        """
+        Gauge được đọc lúc xuất số liệu (ví dụ bộ đếm của cache).
+        """
+        self._callbacks.append((name, help_text, callback))
+
+    def observe_request(self, metrics: RequestMetrics):
+        metrics.finish()
+        for stage, seconds in list(metrics.stages.items()):
+            self.observe("process_stage_duration_seconds", seconds, stage=stage)
+        self.observe("process_request_duration_seconds", metrics.total_seconds)
+        self.inc("process_requests_total")
+        self.inc("process_files_total", metrics.files)
+        self.inc("process_rows_total", metrics.rows)
+        self.inc("process_bytes_parsed_total", metrics.bytes_parsed)
+        if metrics.total_seconds > 0:
+            self.set("process_last_rows_per_second", metrics.rows / metrics.total_seconds)
+
+    def render(self) -> str:
+        lines = []
+
+        def header(name: str, default_type: str):
+            metric_type, help_text = self._help.get(name, (default_type, name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric_type}")
+
+        def fmt(labels: LabelSet, extra: LabelSet = ()) -> str:
+            items = labels + extra
+            if not items:
+                return ""
+            return "{" + ",".join(f'{key}="{_escape_label(value)}"' for key, value in items) + "}"
+
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                header(name, "counter")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{fmt(labels)} {value}")
+            for name, series in sorted(self._gauges.items()):
+                header(name, "gauge")
+                for labels, value in sorted(series.items()):
+                    lines.append(f"{name}{fmt(labels)} {value}")
+            for name, series in sorted(self._histograms.items()):
+                header(name, "histogram")
+                for labels, (buckets, total, count) in sorted(series.items()):
+                    cumulative = 0
+                    for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                        cumulative += bucket_count
+                        lines.append(f"{name}_bucket{fmt(labels, (('le', str(bound)),))} {cumulative}")
+                    lines.append(f"{name}_bucket{fmt(labels, (('le', '+Inf'),))} {count}")
+                    lines.append(f"{name}_sum{fmt(labels)} {total}")
+                    lines.append(f"{name}_count{fmt(labels)} {count}")
+        for name, help_text, callback in self._callbacks:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {callback()}")
+        return "\n".join(lines) + "\n"
+
+def count_api_call(method: str):
+    registry.inc("sheets_api_calls_total", method=method)
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.count_api_call(method)
+
+registry = MetricsRegistry()
+registry.describe("process_stage_duration_seconds", "histogram", "Thời gian từng bước xử lý (cộng dồn theo file) mỗi request")
+registry.describe("process_request_duration_seconds", "histogram", "Tổng thời gian xử lý một request /process")
+registry.describe("process_requests_total", "counter", "Số request /process đã xử lý")
+registry.describe("process_files_total", "counter", "Số file đã xử lý")
+registry.describe("process_rows_total", "counter", "Số hàng nghỉ học đã thống kê")
+registry.describe("process_bytes_parsed_total", "counter", "Số byte file Excel đã parse")
+registry.describe("process_last_rows_per_second", "gauge", "Thông lượng (hàng/giây) của request gần nhất")
+registry.gauge_callback("process_peak_rss_bytes", "RSS lớn nhất của process (byte)", peak_rss_bytes)
+registry.describe("sheets_api_calls_total", "counter", "Số lần gọi Google Sheets API (kể cả retry)")
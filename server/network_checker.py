@@ -1,48 +1,168 @@
 # network_checker.py
-import socket
+import os
 import time
+import socket
+import logging
+import threading
+from collections import deque
+from typing import Deque, Optional, Tuple
+
 import requests
 
-def check_network(timeout=5):
+# Đích kiểm tra có thể cấu hình (ví dụ trỏ tới server giả lập cục bộ khi test)
+PROBE_HOST = os.getenv('NETWORK_PROBE_HOST', '8.8.8.8')  # Google DNS
+PROBE_PORT = int(os.getenv('NETWORK_PROBE_PORT', '53'))
+PROBE_URL = os.getenv('NETWORK_PROBE_URL', 'http://www.google.com')  # URL đơn giản để kiểm tra
+PROBE_TIMEOUT = float(os.getenv('NETWORK_PROBE_TIMEOUT', '5'))
+# Chu kỳ kiểm tra nền (giây) và số mẫu độ trễ giữ lại
+PROBE_INTERVAL = float(os.getenv('NETWORK_PROBE_INTERVAL', '30'))
+PROBE_WINDOW = int(os.getenv('NETWORK_PROBE_WINDOW', '120'))
+
+SLOW_CONNECT_MS = 500
+SLOW_DOWNLOAD_S = 2
+
+def _connect_latency(host: str, port: int, timeout: float) -> float:
+    """
+    Mở kết nối TCP với timeout riêng cho socket này (không đổi socket.setdefaulttimeout của cả process).
+    Trả về độ trễ tính bằng giây.
+    """
+    start_time = time.perf_counter()
+    with socket.create_connection((host, port), timeout=timeout):
+        pass
+    return time.perf_counter() - start_time
+
+def check_network(timeout=PROBE_TIMEOUT, host=PROBE_HOST, port=PROBE_PORT) -> Tuple[bool, str]:
     """
-    Kiểm tra kết nối mạng bằng cách ping đến Google DNS (8.8.8.8) và đo tốc độ phản hồi.
+    Kiểm tra kết nối mạng bằng cách kết nối đến Google DNS (8.8.8.8) và đo tốc độ phản hồi.
     Trả về tuple (is_connected, message).
     """
+    is_connected, message, _ = _check_network(timeout, host, port)
+    return is_connected, message
+
+def _check_network(timeout: float, host: str, port: int) -> Tuple[bool, str, Optional[float]]:
     try:
-        # Kiểm tra kết nối bằng socket
-        start_time = time.time()
-        socket.setdefaulttimeout(timeout)
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        result = sock.connect_ex(('8.8.8.8', 53))  # Google DNS, port 53
-        sock.close()
-        
-        latency = (time.time() - start_time) * 1000  # Đổi sang milliseconds
-        
-        if result == 0:
-            if latency > 500:  # Nếu độ trễ > 500ms, coi là mạng chậm
-                return True, f"Mạng chậm: Độ trễ {latency:.2f}ms vượt quá ngưỡng 500ms."
-            return True, "Kết nối mạng ổn định."
-        else:
-            return False, "Không có kết nối mạng: Không thể ping đến 8.8.8.8."
+        latency = _connect_latency(host, port, timeout) * 1000  # Đổi sang milliseconds
+        if latency > SLOW_CONNECT_MS:  # Nếu độ trễ > 500ms, coi là mạng chậm
+            return True, f"Mạng chậm: Độ trễ {latency:.2f}ms vượt quá ngưỡng {SLOW_CONNECT_MS}ms.", latency
+        return True, "Kết nối mạng ổn định.", latency
     except socket.timeout:
-        return False, "Lỗi mạng: Hết thời gian chờ khi kiểm tra kết nối (timeout)."
+        return False, "Lỗi mạng: Hết thời gian chờ khi kiểm tra kết nối (timeout).", None
+    except OSError:
+        return False, f"Không có kết nối mạng: Không thể ping đến {host}.", None
     except Exception as e:
-        return False, f"Lỗi mạng: {str(e)}."
+        return False, f"Lỗi mạng: {str(e)}.", None
 
-def check_internet_speed():
+def check_internet_speed(url=PROBE_URL, timeout=PROBE_TIMEOUT, session: Optional[requests.Session] = None) -> Tuple[bool, str]:
     """
     Kiểm tra tốc độ tải xuống từ một URL đơn giản.
     Trả về tuple (success, message).
     """
+    success, message, _ = _check_internet_speed(url, timeout, session)
+    return success, message
+
+def _check_internet_speed(url: str, timeout: float, session: Optional[requests.Session]) -> Tuple[bool, str, Optional[float]]:
     try:
-        url = "http://www.google.com"  # URL đơn giản để kiểm tra
-        start_time = time.time()
-        response = requests.get(url, timeout=5)
+        start_time = time.perf_counter()
+        response = (session or requests).get(url, timeout=timeout)
         response.raise_for_status()  # Kiểm tra lỗi HTTP
-        elapsed = time.time() - start_time
-        
-        if elapsed > 2:  # Nếu tải lâu hơn 2 giây
-            return True, f"Mạng chậm: Thời gian tải {elapsed:.2f}s vượt quá ngưỡng 2s."
-        return True, "Tốc độ mạng ổn định."
+        elapsed = time.perf_counter() - start_time
+
+        if elapsed > SLOW_DOWNLOAD_S:  # Nếu tải lâu hơn 2 giây
+            return True, f"Mạng chậm: Thời gian tải {elapsed:.2f}s vượt quá ngưỡng {SLOW_DOWNLOAD_S}s.", elapsed * 1000
+        return True, "Tốc độ mạng ổn định.", elapsed * 1000
     except requests.exceptions.RequestException as e:
-        return False, f"Lỗi mạng: Không thể kết nối internet - {str(e)}."
\ No newline at end of file
+        return False, f"Lỗi mạng: Không thể kết nối internet - {str(e)}.", None
+
+def _percentiles_us(samples) -> dict:
+    """
+    Phân vị (nearest-rank) của các mẫu độ trễ (ms), trả về micro giây.
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return {"samples": 0}
+    def rank(p):
+        return int(ordered[min(len(ordered) - 1, max(0, -(-p * len(ordered) // 100) - 1))] * 1000)
+    return {"samples": len(ordered), "p50": rank(50), "p90": rank(90), "p99": rank(99), "max": int(ordered[-1] * 1000)}
+
+class NetworkProber:
+    """
+    Kiểm tra mạng định kỳ ở thread nền, giữ trạng thái gần nhất và cửa sổ mẫu độ trễ
+    để endpoint /check-network trả kết quả ngay, không chặn request.
+    """
+
+    def __init__(self, host: str = PROBE_HOST, port: int = PROBE_PORT, url: str = PROBE_URL,
+                 timeout: float = PROBE_TIMEOUT, interval: float = PROBE_INTERVAL, window: int = PROBE_WINDOW):
+        self.host = host
+        self.port = port
+        self.url = url
+        self.timeout = timeout
+        self.interval = interval
+        self._session = requests.Session()  # Tái sử dụng kết nối giữa các lần kiểm tra
+        self._connect_samples: Deque[float] = deque(maxlen=window)
+        self._download_samples: Deque[float] = deque(maxlen=window)
+        self._status: Optional[dict] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None
+
+    def probe(self) -> dict:
+        """
+        Chạy một lượt kiểm tra (kết nối + tải) và cập nhật trạng thái.
+        """
+        is_connected, network_message, connect_ms = _check_network(self.timeout, self.host, self.port)
+        if not is_connected:
+            error, message, download_ms = True, network_message, None
+        else:
+            is_speed_ok, speed_message, download_ms = _check_internet_speed(self.url, self.timeout, self._session)
+            if not is_speed_ok:
+                error, message = True, speed_message
+            else:
+                error = False
+                message = f"{network_message} - {speed_message}" if "Mạng chậm" in network_message or "Mạng chậm" in speed_message else "Mạng ổn định."
+
+        with self._lock:
+            if connect_ms is not None:
+                self._connect_samples.append(connect_ms)
+            if download_ms is not None:
+                self._download_samples.append(download_ms)
+            self._status = {"error": error, "message": message, "checkedAt": time.time()}
+            return dict(self._status)
+
+    def status(self) -> dict:
+        """
+        Trạng thái gần nhất kèm phân vị độ trễ (µs). Nếu chưa có lần kiểm tra nào thì kiểm tra ngay.
+        """
+        with self._lock:
+            status = dict(self._status) if self._status is not None else None
+        if status is None:
+            status = self.probe()
+        with self._lock:
+            status["connectLatencyUs"] = _percentiles_us(self._connect_samples)
+            status["downloadLatencyUs"] = _percentiles_us(self._download_samples)
+        return status
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.probe()
+            except Exception as e:
+                logging.error(f"Network probe failed: {e}")
+            self._stop.wait(self.interval)
+
+    def start(self):
+        """
+        Khởi động thread nền (an toàn khi gọi lại, kể cả sau khi process bị fork).
+        """
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._stop.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="network-prober", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+network_prober = NetworkProber()
@@ -0,0 +1,420 @@
+import io
+import os
+import time
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple, Union
+
+from openpyxl.workbook.workbook import Workbook
+from handleExcel import load_uploaded_workbook, summarize_k_attendance
+from uploadGgSheet import probe_sheet, upload_to_google_sheets, write_summary_sheet
+from sheets_writer import is_permanent_error
+from absence_records import AbsenceRecords
+from aggregation import SUMMARY_SHEET_SUFFIX, AbsenceSummary
+from result_cache import make_cache_key, result_cache
+from attendance_store import attendance_store
+import sheet_index
+from validation import ValidationReport, validate_sheet
+from metrics import RequestMetrics, StageTimer, current_metrics, registry
+from stages import FileContext, RowTransform, active_stages, register_stage
+from upload_stream import SpooledUpload
+
+# Số process con dùng để parse/validate/thống kê các file song song (1 = xử lý tuần tự)
+PROCESS_WORKERS = int(os.getenv('PROCESS_WORKERS', '1'))
+# Sheet đã kiểm tra nhận ghi được thì bỏ qua kiểm tra trong bấy nhiêu giây (chế độ store)
+SHEET_PROBE_TTL = float(os.getenv('SHEET_PROBE_TTL', '600'))
+
+# Nội dung file upload: bytes, hoặc SpooledUpload khi nhận theo chế độ streaming
+UploadSource = Union[bytes, SpooledUpload]
+Upload = Tuple[str, UploadSource]
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_workers = 0
+_pool_lock = threading.Lock()
+# (spreadsheet_id, sheet_name) -> thời điểm (monotonic) kiểm tra sheet thành công gần nhất
+_accepted_sheets: Dict[Tuple[str, str], float] = {}
+
+class FileResult(NamedTuple):
+    filename: str
+    records: Optional[AbsenceRecords]
+    error: Optional[str]
+    # Danh sách lỗi chi tiết (row, column, reason) khi file không qua bước kiểm tra
+    issues: Optional[List[dict]] = None
+    # Thời gian từng bước (giây); rỗng nếu file không được parse (lấy từ cache hoặc bị bỏ qua)
+    timings: Optional[Dict[str, float]] = None
+
+def validate_excel_data(workbook: Workbook) -> ValidationReport:
+    return validate_sheet(workbook.active)
+
+def process_single_file(workbook: Workbook, class_name, faculty_name,
+                        session_columns: Optional[List[Tuple[int, str, int]]] = None,
+                        row_transform: Optional[RowTransform] = None) -> Optional[AbsenceRecords]:
+    """
+    Thống kê nghỉ học của một file (None nếu lỗi).
+    Việc ánh xạ A-H và upload được thực hiện một lần cho cả lô trong process_batch.
+    """
+    try:
+        records = summarize_k_attendance(workbook, class_name, faculty_name, session_columns, row_transform)
+        if records is None:
+            logging.error(f"Failed to summarize attendance for {class_name}")
+            return None
+
+        logging.debug(f"Processed {class_name}: {len(records)} rows.")
+        return records
+    except Exception as e:
+        logging.error(f"Error processing {class_name}: {e}")
+        return None
+
+@register_stage("validate")
+def _validate_stage(context: FileContext) -> bool:
+    context.report = validate_excel_data(context.workbook)
+    if not context.report.is_valid:
+        context.error = f"Lỗi file '{context.filename}': {context.report.message()}"
+        context.issues = context.report.to_list()
+        return False
+    return True
+
+@register_stage("summarize")
+def _summarize_stage(context: FileContext) -> bool:
+    # Dùng lại chỉ mục ngày/buổi đã đọc ở bước kiểm tra (nếu có)
+    session_columns = context.report.session_columns if context.report is not None else None
+    context.records = process_single_file(context.workbook, context.class_name, context.faculty_name,
+                                          session_columns, context.row_transform)
+    if context.records is None:
+        context.error = f"Lỗi xử lý file '{context.filename}'."
+        return False
+    return True
+
+def class_name_from_filename(filename: str) -> str:
+    return os.path.basename(filename).replace('.xlsx', '')
+
+def process_uploaded_file(filename: str, data: bytes, faculty_name: str) -> FileResult:
+    """
+    Chạy các bước đã đăng ký (mặc định: kiểm tra -> thống kê) cho một file upload.
+    Hàm ở mức module để có thể gửi sang process con. Kết quả kèm thời gian từng bước (timings).
+    """
+    if not filename.lower().endswith('.xlsx'):
+        return FileResult(filename, None, f"Bỏ qua '{filename}': Không phải Excel.")
+
+    timer = StageTimer()
+    result = _run_file_stages(filename, data, faculty_name, timer)
+    return result._replace(timings=timer.stages)
+
+def _run_file_stages(filename: str, data: bytes, faculty_name: str, timer: StageTimer) -> FileResult:
+    context = FileContext(filename, class_name_from_filename(filename), faculty_name)
+    stages = active_stages(context.faculty)
+    # Đọc workbook một lần, dùng chung cho mọi bước. Chỉ mở ở chế độ ghi khi có bước sửa dữ liệu;
+    # thay đổi được giữ trong bộ nhớ, workbook không bao giờ được save lại
+    read_only = not any(stage.modifies_data for stage in stages)
+    with timer.stage("load"):
+        context.workbook = load_uploaded_workbook(io.BytesIO(data), read_only=read_only)
+    if context.workbook is None:
+        return FileResult(filename, None, f"Lỗi: Không xử lý được ngày và cột cho '{filename}'.")
+
+    try:
+        for stage in stages:
+            with timer.stage(stage.name):
+                if not stage.run(context):
+                    return FileResult(filename, None, context.error or f"Lỗi xử lý file '{filename}'.", context.issues)
+    finally:
+        context.workbook.close()
+    return FileResult(filename, context.records, None)
+
+def _pool_context():
+    # Process của server đã chạy nhiều thread (job, kiểm tra mạng, đồng bộ store, thread của gunicorn):
+    # fork trực tiếp có thể kế thừa lock đang bị giữ và treo process con. forkserver/spawn khởi động process con sạch
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    if context.get_start_method() == 'forkserver':
+        # Forkserver import sẵn pipeline (openpyxl, các bước xử lý) một lần, process con fork từ đó nên khởi động nhanh
+        context.set_forkserver_preload(['pipeline'])
+    return context
+
+def _get_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Pool được tạo trong process phục vụ request (sau khi server fork worker) và dùng lại giữa các request.
+    """
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is None or _pool_workers != workers:
+            if _pool is not None:
+                _pool.shutdown(wait=False)
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=_pool_context())
+            _pool_workers = workers
+            logging.info(f"Started process pool with {workers} workers")
+        return _pool
+
+def start_process_pool():
+    """
+    Tạo pool trước khi các thread nền khởi động (gọi đầu start_background_tasks). Không làm gì khi xử lý tuần tự.
+    """
+    if PROCESS_WORKERS > 1:
+        _get_pool(PROCESS_WORKERS)
+
+def _reset_pool(broken_pool: Optional[ProcessPoolExecutor]):
+    """
+    Bỏ pool bị hỏng (process con chết). Chỉ bỏ đúng pool đã sinh ra future lỗi: pool mới do thread khác vừa tạo
+    vẫn được giữ nguyên.
+    """
+    global _pool
+    if broken_pool is None:
+        return
+    with _pool_lock:
+        if _pool is broken_pool:
+            _pool.shutdown(wait=False)
+            _pool = None
+
+def _read_upload(source: UploadSource) -> bytes:
+    return source if isinstance(source, bytes) else source.read()
+
+def upload_size(source: UploadSource) -> int:
+    return len(source) if isinstance(source, bytes) else source.size
+
+def release_uploads(uploads: List[Upload]):
+    """
+    Đóng các file upload dạng streaming chưa được đọc (file tạm trên đĩa) và xóa danh sách.
+    """
+    for _, source in uploads:
+        if not isinstance(source, bytes):
+            source.close()
+    uploads.clear()
+
+def iter_process_uploads(uploads: List[Upload], faculty_name: str, workers: Optional[int] = None) -> Iterator[FileResult]:
+    """
+    Xử lý danh sách (tên file, nội dung) và sinh kết quả theo đúng thứ tự upload.
+    Nội dung là bytes hoặc SpooledUpload (chế độ streaming): mỗi file chỉ được đọc vào bộ nhớ khi tới lượt
+    và được giải phóng ngay sau khi xử lý xong.
+    File đã có trong result_cache (cùng nội dung, khoa, lớp) được trả ngay, không cần mở bằng openpyxl.
+    Khi workers > 1 các file được xử lý song song trong ProcessPoolExecutor, tối đa 2 * workers file
+    được gửi đi cùng lúc để bộ nhớ không tăng theo số file của lô.
+    """
+    workers = PROCESS_WORKERS if workers is None else workers
+    parallel = workers > 1 and len(uploads) > 1
+
+    def start(index: int):
+        filename, source = uploads[index]
+        data = _read_upload(source)
+        key = None
+        if filename.lower().endswith('.xlsx'):
+            key = make_cache_key(data, faculty_name, class_name_from_filename(filename))
+            records = result_cache.get(key)
+            if records is not None:
+                return filename, None, key, None, FileResult(filename, records, None)
+        if parallel:
+            pool = None
+            try:
+                pool = _get_pool(workers)
+                return filename, data, key, pool, pool.submit(process_uploaded_file, filename, data, faculty_name)
+            except BrokenProcessPool as e:
+                logging.error(f"Process pool broken, processing '{filename}' in-process: {e}")
+                _reset_pool(pool)
+        return filename, None, key, None, process_uploaded_file(filename, data, faculty_name)
+
+    def finish(filename: str, data: Optional[bytes], key: Optional[str], pool: Optional[ProcessPoolExecutor],
+               outcome) -> FileResult:
+        # pool: pool đã nhận future này (mỗi future giữ pool của nó, các future còn chờ không dùng chung biến)
+        if isinstance(outcome, FileResult):
+            result = outcome
+        else:
+            try:
+                result = outcome.result()
+            except BrokenProcessPool as e:
+                logging.error(f"Process pool broken, processing '{filename}' in-process: {e}")
+                _reset_pool(pool)
+                result = process_uploaded_file(filename, data, faculty_name)
+        if result.records is not None and key is not None:
+            result_cache.put(key, result.records)
+        return result
+
+    # Lấy kết quả theo thứ tự upload nên thông báo lỗi giống hệt chế độ tuần tự
+    window = 2 * workers if parallel else 1
+    pending: Deque[tuple] = deque()
+    next_index = 0
+    while pending or next_index < len(uploads):
+        while next_index < len(uploads) and len(pending) < window:
+            pending.append(start(next_index))
+            next_index += 1
+        yield finish(*pending.popleft())
+
+def process_uploads(uploads: List[Upload], faculty_name: str, workers: Optional[int] = None) -> List[FileResult]:
+    return list(iter_process_uploads(uploads, faculty_name, workers))
+
+def _upload_new_rows(rows: List[List[str]], spreadsheet_id: str, sheet_name: str, service) -> Optional[int]:
+    """
+    Chế độ diff: chỉ ghi các hàng chưa có trên sheet (theo index cục bộ). Trả về số hàng đã ghi, None nếu lỗi.
+    """
+    with sheet_index.sheet_lock(spreadsheet_id, sheet_name):
+        try:
+            new_rows = sheet_index.filter_new_rows(service, spreadsheet_id, sheet_name, rows)
+        except Exception as e:
+            logging.error(f"Error building row index for {sheet_name}: {e}")
+            return None
+        logging.info(f"Diff upload: {len(new_rows)} new rows, {len(rows) - len(new_rows)} already on sheet")
+        # write_rows ghi nhận khóa các hàng vào log dùng chung (hoặc buộc đọc lại sheet nếu lỗi giữa chừng)
+        if not upload_to_google_sheets(new_rows, spreadsheet_id, sheet_name, service):
+            return None
+        return len(new_rows)
+
+def _sheet_accepts_writes(service, spreadsheet_id: str, sheet_name: str) -> bool:
+    """
+    Kiểm tra nhanh sheet đích (probe_sheet: một request, không retry, timeout ngắn) trước khi nhận lô vào store:
+    lỗi vĩnh viễn (không có quyền, spreadsheet/sheet không tồn tại) được báo ngay như khi ghi trực tiếp.
+    Lỗi tạm thời (mạng, quota, 5xx) hay bucket đang cạn không chặn: lô vẫn được lưu, lỗi vĩnh viễn phát sinh sau đó
+    được thread đồng bộ đánh dấu trên từng bản ghi (syncState "failed").
+    Kết quả thành công được nhớ SHEET_PROBE_TTL giây nên các lô tiếp theo của cùng sheet không gọi Sheets.
+    """
+    key = (spreadsheet_id, sheet_name)
+    checked = _accepted_sheets.get(key)
+    if checked is not None and time.monotonic() - checked < SHEET_PROBE_TTL:
+        return True
+    try:
+        if probe_sheet(service, spreadsheet_id, sheet_name):
+            _accepted_sheets[key] = time.monotonic()
+        return True
+    except Exception as e:
+        if is_permanent_error(e):
+            logging.error(f"Sheet {spreadsheet_id}/{sheet_name} rejected writes: {e}")
+            return False
+        logging.warning(f"Could not check sheet {sheet_name}, storing rows for later sync: {e}")
+        return True
+
+def process_batch(uploads: List[Upload], faculty_name: str, spreadsheet_id: str, sheet_name: str, service,
+                  on_file_done: Optional[Callable[[int, FileResult], None]] = None, diff: bool = False,
+                  metrics: Optional[RequestMetrics] = None) -> dict:
+    """
+    Xử lý cả lô file rồi ghi lên Google Sheets một lần duy nhất.
+    Trả về dict kết quả (status, successfulFiles, totalRowsAdded, error, errors) như response của /process.
+    on_file_done(index, result) được gọi sau mỗi file để báo tiến độ.
+    diff=True chỉ ghi các hàng (ngày, họ tên, lớp, buổi) chưa có trên sheet.
+    Khi bật ATTENDANCE_STORE_PATH (và không ở chế độ diff), bản ghi chỉ được commit vào store cục bộ,
+    thread nền của attendance_store đồng bộ lên Sheets sau (response có pendingSync).
+    metrics ghi nhận thời gian từng bước, số byte/hàng và số lần gọi API của lô.
+    """
+    return _run_with_metrics(metrics, _process_batch, uploads, faculty_name, spreadsheet_id, sheet_name, service,
+                             on_file_done, diff)
+
+def _run_with_metrics(metrics: Optional[RequestMetrics], func, *args) -> dict:
+    # Gắn metrics vào context (để đếm lời gọi API ở tầng thấp) và ghi nhận vào registry khi xong
+    metrics = metrics if metrics is not None else RequestMetrics()
+    token = current_metrics.set(metrics)
+    try:
+        return func(*args, metrics)
+    finally:
+        current_metrics.reset(token)
+        registry.observe_request(metrics)
+
+def _collect_records(uploads: List[Upload], faculty_name: str, on_file_done, metrics: RequestMetrics,
+                     errors: List[str]) -> Tuple[AbsenceRecords, List[str]]:
+    """
+    Gom bản ghi của mọi file trong lô. Trả về (bản ghi, tên các file xử lý được); lỗi từng file được thêm vào errors.
+    """
+    batch_records = AbsenceRecords()
+    processed_files = []
+    for index, result in enumerate(iter_process_uploads(uploads, faculty_name)):
+        metrics.files += 1
+        if result.timings:
+            metrics.merge_stages(result.timings)
+            metrics.bytes_parsed += upload_size(uploads[index][1])
+        if on_file_done is not None:
+            on_file_done(index, result)
+        if result.error:
+            errors.append(result.error)
+            continue
+        batch_records.extend(result.records)
+        processed_files.append(result.filename)
+    metrics.rows = len(batch_records)
+    return batch_records, processed_files
+
+def _process_batch(uploads, faculty_name, spreadsheet_id, sheet_name, service, on_file_done, diff,
+                   metrics: RequestMetrics) -> dict:
+    successful_files = 0
+    total_rows_added = 0
+    errors = []
+    # Gom bản ghi của mọi file để ghi lên Google Sheets một lần duy nhất
+    batch_records, processed_files = _collect_records(uploads, faculty_name, on_file_done, metrics, errors)
+
+    skipped_rows = 0
+    stored = False
+    if processed_files and not diff and attendance_store.enabled:
+        # Write-behind: commit vào store cục bộ, thread nền đồng bộ lên Sheets (diff cần đọc sheet nên vẫn ghi trực tiếp)
+        try:
+            with metrics.stage("store"):
+                if _sheet_accepts_writes(service, spreadsheet_id, sheet_name):
+                    total_rows_added = attendance_store.add(spreadsheet_id, sheet_name, batch_records)
+                    successful_files = len(processed_files)
+                else:
+                    errors.extend(f"Lỗi xử lý file '{filename}'." for filename in processed_files)
+            stored = True
+        except Exception as e:
+            logging.error(f"Error writing attendance store, uploading directly: {e}")
+
+    if processed_files and not stored:
+        with metrics.stage("map_rows"):
+            rows_to_upload = batch_records.to_sheet_rows()
+        with metrics.stage("upload"):
+            if diff:
+                uploaded_rows = _upload_new_rows(rows_to_upload, spreadsheet_id, sheet_name, service)
+            else:
+                uploaded_rows = len(rows_to_upload) if upload_to_google_sheets(rows_to_upload, spreadsheet_id, sheet_name, service) else None
+        if uploaded_rows is not None:
+            successful_files = len(processed_files)
+            total_rows_added = uploaded_rows
+            skipped_rows = len(rows_to_upload) - uploaded_rows
+        else:
+            errors.extend(f"Lỗi xử lý file '{filename}'." for filename in processed_files)
+
+    status = f"Xử lý hoàn tất: {successful_files} file thành công, {total_rows_added} hàng."
+    response = {"status": status, "successfulFiles": successful_files, "totalRowsAdded": total_rows_added, "error": False}
+    if diff:
+        response["skippedRows"] = skipped_rows
+    if stored and successful_files:
+        # Các hàng đã lưu cục bộ, sẽ xuất hiện trên Google Sheets sau khi thread nền đồng bộ
+        response["pendingSync"] = True
+    if errors:
+        response["errors"] = errors
+    logging.info(status)
+    return response
+
+def aggregate_batch(uploads: List[Upload], faculty_name: str, spreadsheet_id: str, sheet_name: str, service,
+                    on_file_done: Optional[Callable[[int, FileResult], None]] = None,
+                    metrics: Optional[RequestMetrics] = None, summary_sheet_name: Optional[str] = None) -> dict:
+    """
+    Chế độ thống kê: đếm số lượt nghỉ theo học sinh, lớp và ngày của cả lô rồi ghi một tab thống kê
+    (mặc định "<sheet_name>_Thong_ke", đặt cạnh tab chi tiết) thay vì ghi từng hàng chi tiết.
+    """
+    summary_sheet_name = summary_sheet_name or f"{sheet_name}{SUMMARY_SHEET_SUFFIX}"
+    return _run_with_metrics(metrics, _aggregate_batch, uploads, faculty_name, spreadsheet_id, sheet_name,
+                             summary_sheet_name, service, on_file_done)
+
+def _aggregate_batch(uploads, faculty_name, spreadsheet_id, sheet_name, summary_sheet_name, service, on_file_done,
+                     metrics: RequestMetrics) -> dict:
+    errors = []
+    batch_records, processed_files = _collect_records(uploads, faculty_name, on_file_done, metrics, errors)
+
+    summary = None
+    if processed_files:
+        with metrics.stage("aggregate"):
+            summary = AbsenceSummary.from_records(batch_records)
+            summary_rows = summary.to_sheet_rows()
+        with metrics.stage("upload"):
+            written = write_summary_sheet(summary_rows, spreadsheet_id, summary_sheet_name, service, sheet_name)
+        if not written:
+            errors.extend(f"Lỗi xử lý file '{filename}'." for filename in processed_files)
+            summary = None
+
+    successful_files = len(processed_files) if summary is not None else 0
+    total = summary.total if summary is not None else 0
+    status = f"Thống kê hoàn tất: {successful_files} file thành công, {total} lượt nghỉ."
+    response = {"status": status, "successfulFiles": successful_files, "totalAbsences": total,
+                "students": len(summary.students) if summary is not None else 0,
+                "classes": len(summary.classes) if summary is not None else 0,
+                "dates": len(summary.dates) if summary is not None else 0,
+                "summarySheet": summary_sheet_name, "error": False}
+    if errors:
+        response["errors"] = errors
+    logging.info(status)
+    return response
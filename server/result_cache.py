@@ -0,0 +1,137 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from absence_records import AbsenceRecords
+from metrics import registry
+from stages import faculty_key, pipeline_signature
+
+# Số kết quả giữ trong bộ nhớ (LRU)
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '256'))
+# Thư mục lưu tầng cache trên đĩa (để trống = tắt), dùng chung được giữa các worker process
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', '')
+RESULT_CACHE_DISK_MAX_ENTRIES = int(os.getenv('RESULT_CACHE_DISK_MAX_ENTRIES', '2048'))
+
+# Tăng khi logic đọc/kiểm tra/thống kê hoặc định dạng AbsenceRecords thay đổi, để tầng đĩa (tồn tại qua các lần
+# deploy) không trả kết quả của phiên bản cũ
+RESULT_CACHE_VERSION = 2
+
+def make_cache_key(data: bytes, faculty_name: str, class_name: str) -> str:
+    """
+    Khóa cache: SHA-256 của phiên bản cache, các bước/biến đổi hàng đang đăng ký cho khoa,
+    nội dung file, khoa và tên lớp (tên lớp lấy từ tên file và nằm trong từng bản ghi).
+    """
+    digest = hashlib.sha256(f"v{RESULT_CACHE_VERSION}\0{pipeline_signature(faculty_key(faculty_name))}\0".encode('utf-8'))
+    digest.update(data)
+    digest.update(b'\0' + faculty_name.encode('utf-8') + b'\0' + class_name.encode('utf-8'))
+    return digest.hexdigest()
+
+class ResultCache:
+    """
+    Cache kết quả thống kê nghỉ học theo nội dung file: tầng bộ nhớ LRU và tầng đĩa (tùy chọn).
+    """
+
+    def __init__(self, max_entries: int = RESULT_CACHE_MAX_ENTRIES, disk_dir: str = RESULT_CACHE_DIR,
+                 disk_max_entries: int = RESULT_CACHE_DISK_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.disk_max_entries = disk_max_entries
+        self._entries: "OrderedDict[str, AbsenceRecords]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _remember(self, key: str, records: AbsenceRecords):
+        self._entries[key] = records
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key: str) -> Optional[AbsenceRecords]:
+        with self._lock:
+            records = self._entries.get(key)
+            if records is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return records
+
+        records = self._read_disk(key)
+        with self._lock:
+            if records is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._remember(key, records)
+            return records
+
+    def put(self, key: str, records: AbsenceRecords):
+        with self._lock:
+            self._remember(key, records)
+        self._write_disk(key, records)
+
+    def _read_disk(self, key: str) -> Optional[AbsenceRecords]:
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(key), encoding='utf-8') as f:
+                records = AbsenceRecords.from_dict(json.load(f))
+            os.utime(self._disk_path(key))  # Cập nhật mtime để tầng đĩa cũng dọn theo LRU
+            return records
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logging.warning(f"Error reading result cache entry {key}: {e}")
+            return None
+
+    def _write_disk(self, key: str, records: AbsenceRecords):
+        if not self.disk_dir:
+            return
+        try:
+            tmp_path = f"{self._disk_path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(records.to_dict(), f, ensure_ascii=False)
+            os.replace(tmp_path, self._disk_path(key))
+            self._prune_disk()
+        except Exception as e:
+            logging.warning(f"Error writing result cache entry {key}: {e}")
+
+    def _prune_disk(self):
+        entries = [os.path.join(self.disk_dir, name) for name in os.listdir(self.disk_dir) if name.endswith('.json')]
+        if len(entries) <= self.disk_max_entries:
+            return
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:len(entries) - self.disk_max_entries]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "diskHits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "maxEntries": self.max_entries,
+                "hitRatio": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+result_cache = ResultCache()
+registry.gauge_callback("result_cache_hits", "Số lần lấy được kết quả từ cache bộ nhớ", lambda: result_cache.hits)
+registry.gauge_callback("result_cache_disk_hits", "Số lần lấy được kết quả từ cache trên đĩa", lambda: result_cache.disk_hits)
+registry.gauge_callback("result_cache_misses", "Số lần không có kết quả trong cache", lambda: result_cache.misses)
@@ -0,0 +1,116 @@
+import os
+import json
+import logging
+import threading
+from typing import Dict, List, Optional, Set, Tuple
+
+from file_lock import FileLock, state_path
+from sheets_writer import execute_with_retry
+
+# Khóa một bản ghi nghỉ học trên sheet: (Ngày, Họ và tên HSSV, Lớp, Nề nếp Buổi) - cột B, D, F, H
+RowKey = Tuple[str, str, str, str]
+
+# Log khóa dùng chung lớn hơn ngần này (byte) thì được bỏ, mọi worker đọc lại sheet một lần
+SHEET_INDEX_LOG_MAX_BYTES = int(os.getenv('SHEET_INDEX_LOG_MAX_BYTES', str(32 * 1024 * 1024)))
+
+# Index theo sheet kèm (generation của sheet, vị trí đã đọc tới trong log khóa) lúc index được dựng/cập nhật
+_indexes: Dict[Tuple[str, str], Tuple[int, int, Set[RowKey]]] = {}
+_sheet_locks: Dict[Tuple[str, str], FileLock] = {}
+_locks_guard = threading.Lock()
+
+def row_key(row: List[str]) -> RowKey:
+    """
+    Lấy khóa từ một hàng đã ánh xạ A-H (như AbsenceRecords.to_sheet_rows).
+    """
+    padded = list(row) + [""] * (8 - len(row))
+    return (padded[1], padded[3], padded[5], padded[7])
+
+def sheet_lock(spreadsheet_id: str, sheet_name: str) -> FileLock:
+    """
+    Lock theo từng sheet, loại trừ cả giữa các thread lẫn các worker process. Mọi lần ghi hàng chi tiết giữ lock này
+    trong suốt kiểm tra header -> append (và lọc/cập nhật index ở chế độ diff) để hai lô cùng sheet không ghi đè
+    hay ghi trùng lên nhau. Cùng thread có thể lấy lồng nhau.
+    """
+    with _locks_guard:
+        lock = _sheet_locks.get((spreadsheet_id, sheet_name))
+        if lock is None:
+            lock = _sheet_locks[(spreadsheet_id, sheet_name)] = FileLock(state_path(spreadsheet_id, sheet_name))
+        return lock
+
+def _generation_path(spreadsheet_id: str, sheet_name: str) -> str:
+    return state_path(spreadsheet_id, sheet_name, suffix='.generation')
+
+def _log_path(spreadsheet_id: str, sheet_name: str) -> str:
+    return state_path(spreadsheet_id, sheet_name, suffix='.keys')
+
+def _read_generation(spreadsheet_id: str, sheet_name: str) -> int:
+    try:
+        with open(_generation_path(spreadsheet_id, sheet_name), encoding='utf-8') as f:
+            return int(f.read() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def _log_size(spreadsheet_id: str, sheet_name: str) -> int:
+    try:
+        return os.path.getsize(_log_path(spreadsheet_id, sheet_name))
+    except OSError:
+        return 0
+
+def note_write(spreadsheet_id: str, sheet_name: str, rows: Optional[List[List[str]]] = None):
+    """
+    Ghi nhận một lần ghi hàng lên sheet, gọi khi đang giữ sheet_lock. Trạng thái nằm trong SHEETS_STATE_DIR
+    nên mọi worker process thấy được:
+    - rows: các hàng đã ghi xong, khóa được nối vào log dùng chung, index của các worker chỉ cần đọc thêm phần mới;
+    - None (ghi lỗi, có thể đã ghi một phần): tăng generation và bỏ log, index của mọi worker đọc lại sheet.
+    """
+    if rows is not None and _log_size(spreadsheet_id, sheet_name) < SHEET_INDEX_LOG_MAX_BYTES:
+        with open(_log_path(spreadsheet_id, sheet_name), 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(row_key(row), ensure_ascii=False) + '\n' for row in rows)
+        return
+    generation = _read_generation(spreadsheet_id, sheet_name) + 1
+    with open(_generation_path(spreadsheet_id, sheet_name), 'w', encoding='utf-8') as f:
+        f.write(str(generation))
+    with open(_log_path(spreadsheet_id, sheet_name), 'w', encoding='utf-8'):
+        pass
+
+def _read_log(spreadsheet_id: str, sheet_name: str, offset: int) -> Tuple[int, List[RowKey]]:
+    # Đọc các khóa được ghi vào log từ vị trí offset, trả về (vị trí mới, danh sách khóa)
+    try:
+        with open(_log_path(spreadsheet_id, sheet_name), 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+    except OSError:
+        return offset, []
+    return offset + len(data), [tuple(json.loads(line)) for line in data.decode('utf-8').splitlines() if line]
+
+def _load_index(service, spreadsheet_id: str, sheet_name: str) -> Set[RowKey]:
+    """
+    Đọc các khóa đã có trên sheet (cột A-H) một lần, sau đó index được cập nhật từ log khóa dùng chung
+    (các hàng do process này hay worker khác ghi). Chỉ đọc lại sheet khi generation đổi (có lần ghi lỗi).
+    """
+    generation = _read_generation(spreadsheet_id, sheet_name)
+    cached = _indexes.get((spreadsheet_id, sheet_name))
+    if cached is not None and cached[0] == generation:
+        offset, keys = _read_log(spreadsheet_id, sheet_name, cached[1])
+        cached[2].update(keys)
+        _indexes[(spreadsheet_id, sheet_name)] = (generation, offset, cached[2])
+        return cached[2]
+
+    # Hàng trong log đã nằm trên sheet: bắt đầu đọc log từ cuối file hiện tại
+    offset = _log_size(spreadsheet_id, sheet_name)
+    values = execute_with_retry(lambda: service.spreadsheets().values().get(
+        spreadsheetId=spreadsheet_id,
+        range=f'{sheet_name}!A:H'
+    ), "values.get").get('values', [])
+    index = {row_key(row) for row in values}
+    _indexes[(spreadsheet_id, sheet_name)] = (generation, offset, index)
+    logging.info(f"Built row index for {spreadsheet_id}/{sheet_name}: {len(index)} keys")
+    return index
+
+def filter_new_rows(service, spreadsheet_id: str, sheet_name: str, rows: List[List[str]]) -> List[List[str]]:
+    """
+    Chỉ giữ các hàng chưa có trên sheet. Gọi khi đang giữ sheet_lock.
+    Các hàng trùng khóa trong cùng một lô (ví dụ nghỉ cả C1 và C2 buổi sáng) vẫn được giữ như khi upload thường.
+    """
+    index = _load_index(service, spreadsheet_id, sheet_name)
+    return [row for row in rows if row_key(row) not in index]
@@ -0,0 +1,282 @@
+import os
+import re
+import time
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Tuple
+
+from googleapiclient.errors import HttpError
+
+from file_lock import FileLock, state_path
+from metrics import count_api_call
+
+# Số request ghi chạy song song tối đa
+SHEETS_MAX_IN_FLIGHT = int(os.getenv('SHEETS_MAX_IN_FLIGHT', '4'))
+# Tốc độ request trung bình (request/giây) và số request được phép dồn; mặc định khớp quota 60 request/phút/người dùng
+SHEETS_REQUESTS_PER_SECOND = float(os.getenv('SHEETS_REQUESTS_PER_SECOND', '1'))
+SHEETS_REQUEST_BURST = int(os.getenv('SHEETS_REQUEST_BURST', '10'))
+# Retry khi bị giới hạn quota (429) hoặc lỗi phía server (5xx)
+SHEETS_MAX_RETRIES = int(os.getenv('SHEETS_MAX_RETRIES', '6'))
+SHEETS_BACKOFF_BASE = float(os.getenv('SHEETS_BACKOFF_BASE', '1'))
+SHEETS_BACKOFF_MAX = float(os.getenv('SHEETS_BACKOFF_MAX', '64'))
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+class TokenBucket:
+    """
+    Giới hạn tốc độ gọi API: mỗi request lấy một token, token được nạp lại đều theo rate (token/giây).
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self, tokens: float, elapsed: float) -> Tuple[float, float]:
+        # Nạp token theo thời gian đã trôi qua rồi lấy một token nếu đủ; trả về (số token còn lại, thời gian cần chờ)
+        tokens = min(self.capacity, tokens + elapsed * self.rate)
+        if tokens >= 1:
+            return tokens - 1, 0.0
+        return tokens, (1 - tokens) / self.rate
+
+    def _try_acquire(self) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self._tokens, wait = self._take(self._tokens, now - self._updated)
+            self._updated = now
+            return wait
+
+    def try_acquire(self) -> bool:
+        """
+        Lấy một token nếu có sẵn, không chờ. Trả về False khi bucket đang cạn.
+        """
+        return self.rate <= 0 or self._try_acquire() <= 0
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            wait = self._try_acquire()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+class SharedTokenBucket(TokenBucket):
+    """
+    Token bucket dùng chung giữa các worker process: số token và thời điểm nạp nằm trong một file
+    của SHEETS_STATE_DIR, được đọc/ghi dưới FileLock, nên tổng tốc độ của mọi worker vẫn là rate.
+    """
+
+    def __init__(self, rate: float, capacity: int, name: str = 'sheets-request-bucket'):
+        super().__init__(rate, capacity)
+        self._file_lock = FileLock(state_path(name))
+        self._state_file = state_path(name, suffix='.bucket')
+
+    def _try_acquire(self) -> float:
+        with self._file_lock:
+            now = time.time()
+            tokens, updated = float(self.capacity), now
+            try:
+                with open(self._state_file, encoding='utf-8') as f:
+                    tokens, updated = (float(value) for value in f.read().split())
+            except (OSError, ValueError):
+                pass  # Chưa có file hoặc file hỏng: bắt đầu với bucket đầy
+            tokens, wait = self._take(tokens, max(0.0, now - updated))
+            with open(self._state_file, 'w', encoding='utf-8') as f:
+                f.write(f"{tokens} {now}")
+            return wait
+
+# Quota Sheets tính theo project/người dùng nên dùng chung một bucket cho mọi thread và mọi worker process
+request_bucket = SharedTokenBucket(SHEETS_REQUESTS_PER_SECOND, SHEETS_REQUEST_BURST)
+
+def _http_status(error: Exception) -> Optional[int]:
+    if isinstance(error, HttpError):
+        return error.resp.status
+    return None
+
+def is_permanent_error(error: Exception) -> bool:
+    """
+    Lỗi 4xx (trừ 429) của Sheets API: không có quyền (403), không tìm thấy spreadsheet (404),
+    tên sheet/range sai (400)... Thử lại không giúp được, cần báo cho người dùng.
+    """
+    status = _http_status(error)
+    return status is not None and 400 <= status < 500 and status not in RETRYABLE_STATUSES
+
+def _retry_after(error: Exception) -> Optional[float]:
+    if isinstance(error, HttpError):
+        value = error.resp.get('retry-after')
+        if value and value.isdigit():
+            return float(value)
+    return None
+
+def execute_with_retry(make_request: Callable, method: str = "request", retry_statuses=RETRYABLE_STATUSES,
+                       retry_transport: bool = True, max_retries: int = SHEETS_MAX_RETRIES,
+                       bucket: TokenBucket = request_bucket):
+    """
+    Gọi make_request().execute() qua token bucket; lỗi 429/5xx (và lỗi kết nối nếu retry_transport)
+    được thử lại với exponential backoff + full jitter, tôn trọng header Retry-After nếu có.
+    """
+    attempt = 0
+    while True:
+        bucket.acquire()
+        count_api_call(method)
+        try:
+            return make_request().execute()
+        except (HttpError, OSError) as e:
+            status = _http_status(e)
+            retryable = status in retry_statuses if status is not None else retry_transport
+            if not retryable or attempt >= max_retries:
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = random.uniform(0, min(SHEETS_BACKOFF_MAX, SHEETS_BACKOFF_BASE * (2 ** attempt)))
+            attempt += 1
+            logging.warning(f"Sheets request failed ({status or e}), retry {attempt}/{max_retries} in {delay:.2f}s")
+            time.sleep(delay)
+
+def _last_row(updated_range: str) -> int:
+    """
+    Lấy số hàng cuối từ updatedRange, ví dụ "Bao_cao!A101:H600" -> 600.
+    """
+    match = re.search(r'![A-Z]+(\d+)(?::[A-Z]+(\d+))?$', updated_range or '')
+    if not match:
+        raise ValueError(f"Unexpected updatedRange: {updated_range}")
+    return int(match.group(2) or match.group(1))
+
+class SheetsWriter:
+    """
+    Ghi các hàng A-H lên sheet theo chunk. Chunk đầu được values().append (INSERT_ROWS): Sheets tự xác định cuối bảng
+    nên không ghi đè hàng của lô khác hay dữ liệu nằm dưới bảng. Khi còn nhiều chunk, số hàng còn lại được giữ chỗ
+    ngay dưới chunk đầu (insertDimension/appendDimension) rồi ghi song song (tối đa max_in_flight request)
+    bằng values().update vào đúng vùng đã giữ; update idempotent nên retry được cả 5xx và lỗi kết nối.
+    Người gọi giữ sheet_index.sheet_lock để không lô nào khác ghi vào sheet giữa lúc giữ chỗ và ghi.
+    """
+
+    def __init__(self, service, chunk_size: int, max_in_flight: int = SHEETS_MAX_IN_FLIGHT):
+        self.service = service
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+
+    def get_values(self, spreadsheet_id: str, range_name: str) -> List[List[str]]:
+        result = execute_with_retry(lambda: self.service.spreadsheets().values().get(
+            spreadsheetId=spreadsheet_id,
+            range=range_name
+        ), "values.get")
+        return result.get('values', [])
+
+    def _append(self, spreadsheet_id: str, sheet_name: str, values: List[List[str]]) -> int:
+        # Append không idempotent: chỉ retry khi chắc chắn request bị từ chối (429), không retry 5xx/lỗi kết nối
+        result = execute_with_retry(lambda: self.service.spreadsheets().values().append(
+            spreadsheetId=spreadsheet_id,
+            range=f"{sheet_name}!A:H",
+            valueInputOption="RAW",
+            insertDataOption="INSERT_ROWS",
+            body={"values": values}
+        ), "values.append", retry_statuses={429}, retry_transport=False)
+        updated_range = result.get('updates', {}).get('updatedRange')
+        logging.debug(f"Appended chunk to {updated_range}")
+        return _last_row(updated_range)
+
+    def _update(self, spreadsheet_id: str, sheet_name: str, start_row: int, values: List[List[str]]):
+        range_name = f"{sheet_name}!A{start_row}:H{start_row + len(values) - 1}"
+        execute_with_retry(lambda: self.service.spreadsheets().values().update(
+            spreadsheetId=spreadsheet_id,
+            range=range_name,
+            valueInputOption="RAW",
+            body={"values": values}
+        ), "values.update")
+        logging.debug(f"Updated chunk {range_name}")
+
+    def _grid(self, spreadsheet_id: str, sheet_name: str) -> Tuple[int, int]:
+        # (sheetId, số hàng của lưới) của tab, cần cho insertDimension/deleteDimension
+        metadata = execute_with_retry(lambda: self.service.spreadsheets().get(
+            spreadsheetId=spreadsheet_id,
+            fields="sheets.properties(sheetId,title,gridProperties.rowCount)"
+        ), "spreadsheets.get")
+        for sheet in metadata.get('sheets', []):
+            properties = sheet.get('properties', {})
+            if properties.get('title') == sheet_name:
+                return properties.get('sheetId', 0), properties.get('gridProperties', {}).get('rowCount', 0)
+        raise ValueError(f"Sheet not found: {sheet_name}")
+
+    def _batch_update(self, spreadsheet_id: str, request: dict):
+        # Thêm/xóa hàng không idempotent: chỉ retry khi bị từ chối vì quota
+        execute_with_retry(lambda: self.service.spreadsheets().batchUpdate(
+            spreadsheetId=spreadsheet_id,
+            body={"requests": [request]}
+        ), "spreadsheets.batchUpdate", retry_statuses={429}, retry_transport=False)
+
+    def _reserve_rows(self, spreadsheet_id: str, sheet_id: int, row_count: int, after_row: int, count: int):
+        """
+        Giữ chỗ count hàng trống ngay sau hàng after_row; dữ liệu nằm dưới (nếu có) bị đẩy xuống như khi append.
+        """
+        if after_row >= row_count:
+            request = {"appendDimension": {"sheetId": sheet_id, "dimension": "ROWS", "length": after_row + count - row_count}}
+        else:
+            request = {"insertDimension": {"range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": after_row,
+                                                     "endIndex": after_row + count}, "inheritFromBefore": True}}
+        self._batch_update(spreadsheet_id, request)
+
+    def _release_rows(self, spreadsheet_id: str, sheet_id: int, first_row: int, last_row: int):
+        """
+        Xóa các hàng first_row..last_row (đánh số từ 1) đã giữ chỗ nhưng không được xác nhận ghi đủ,
+        để bảng không còn hàng trống hay hàng ghi lệch thứ tự. Lỗi chỉ được ghi log.
+        """
+        try:
+            self._batch_update(spreadsheet_id, {"deleteDimension": {"range": {
+                "sheetId": sheet_id, "dimension": "ROWS", "startIndex": first_row - 1, "endIndex": last_row}}})
+        except Exception as e:
+            logging.error(f"Could not release reserved rows {first_row}-{last_row}: {e}")
+
+    def write(self, spreadsheet_id: str, sheet_name: str, rows: List[List[str]],
+              on_chunk: Optional[Callable[[int], None]] = None) -> int:
+        """
+        Ghi rows vào sau dữ liệu hiện có của sheet, trả về số hàng cuối đã ghi. Lỗi được ném ra.
+        on_chunk(n) được gọi theo thứ tự chunk, sau khi Sheets đã xác nhận n hàng đầu của rows.
+        """
+        chunks = [rows[start:start + self.chunk_size] for start in range(0, len(rows), self.chunk_size)]
+        # Giữ chỗ tốn thêm 2 request (đọc sheetId, thêm hàng): ít chunk thì append nối tiếp nhanh hơn
+        if self.max_in_flight <= 1 or len(chunks) <= 3:
+            last_row = 0
+            written = 0
+            for chunk in chunks:
+                last_row = self._append(spreadsheet_id, sheet_name, chunk)
+                written += len(chunk)
+                if on_chunk is not None:
+                    on_chunk(written)
+            return last_row
+
+        first_last_row = self._append(spreadsheet_id, sheet_name, chunks[0])
+        written = len(chunks[0])
+        if on_chunk is not None:
+            on_chunk(written)
+
+        sheet_id, row_count = self._grid(spreadsheet_id, sheet_name)
+        self._reserve_rows(spreadsheet_id, sheet_id, row_count, first_last_row, len(rows) - written)
+        starts = []
+        next_row = first_last_row + 1
+        for chunk in chunks[1:]:
+            starts.append(next_row)
+            next_row += len(chunk)
+
+        executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="sheets-writer")
+        try:
+            futures = [executor.submit(self._update, spreadsheet_id, sheet_name, start, chunk)
+                       for start, chunk in zip(starts, chunks[1:])]
+            for future, chunk in zip(futures, chunks[1:]):
+                future.result()
+                written += len(chunk)
+                if on_chunk is not None:
+                    on_chunk(written)
+        except BaseException:
+            # Chunk sau có thể đã ghi xong khi chunk trước lỗi: bỏ mọi hàng sau phần đã xác nhận,
+            # lần ghi lại chỉ nối tiếp các hàng chưa được báo qua on_chunk
+            executor.shutdown(wait=True, cancel_futures=True)
+            self._release_rows(spreadsheet_id, sheet_id, first_last_row + 1 + written - len(chunks[0]), next_row - 1)
+            raise
+        executor.shutdown(wait=True)
+        return next_row - 1
@@ -0,0 +1,107 @@
+from collections import defaultdict
+from typing import Callable, Dict, FrozenSet, Iterable, List, NamedTuple, Optional
+
+from openpyxl.workbook.workbook import Workbook
+
+from absence_records import AbsenceRecords
+from handleExcel import EChange
+from validation import ValidationReport
+
+# Biến đổi một hàng (tuple giá trị từ iter_rows) trước khi thống kê; chạy ngay trong lượt đọc của bước thống kê
+RowTransform = Callable[[tuple], tuple]
+
+class FileContext:
+    """
+    Trạng thái của một file khi đi qua các bước xử lý.
+    Bước kết thúc sớm bằng cách đặt error (và issues nếu có) rồi trả về False.
+    """
+
+    __slots__ = ("filename", "class_name", "faculty_name", "faculty", "workbook", "report", "records",
+                 "row_transform", "error", "issues")
+
+    def __init__(self, filename: str, class_name: str, faculty_name: str):
+        self.filename = filename
+        self.class_name = class_name
+        self.faculty_name = faculty_name
+        self.faculty = faculty_key(faculty_name)
+        self.workbook: Optional[Workbook] = None
+        self.report: Optional[ValidationReport] = None
+        self.records: Optional[AbsenceRecords] = None
+        self.row_transform = compose_row_transforms(self.faculty)
+        self.error: Optional[str] = None
+        self.issues: Optional[List[dict]] = None
+
+class Stage(NamedTuple):
+    name: str
+    run: Callable[[FileContext], bool]
+    # True nếu bước sửa nội dung workbook (khi đó workbook được mở ở chế độ ghi thay vì read-only)
+    modifies_data: bool = False
+    # Chỉ chạy cho các khoa này (None = mọi khoa)
+    faculties: Optional[FrozenSet[EChange]] = None
+
+    def applies_to(self, faculty: Optional[EChange]) -> bool:
+        return self.faculties is None or faculty in self.faculties
+
+_stages: List[Stage] = []
+_row_transforms: Dict[EChange, List[RowTransform]] = defaultdict(list)
+
+def register_stage(name: str, modifies_data: bool = False, faculties: Optional[Iterable[EChange]] = None,
+                   before: Optional[str] = None):
+    """
+    Decorator đăng ký một bước xử lý file: hàm nhận FileContext, trả về False để dừng xử lý file đó.
+    Bước được thêm vào cuối, hoặc ngay trước bước tên before.
+    Đăng ký ở mức module (lúc import) để process con của pipeline cũng có cùng danh sách bước.
+    """
+    def decorator(func: Callable[[FileContext], bool]):
+        stage = Stage(name, func, modifies_data, frozenset(faculties) if faculties is not None else None)
+        names = [s.name for s in _stages]
+        if name in names:
+            raise ValueError(f"Stage '{name}' is already registered")
+        _stages.insert(names.index(before) if before is not None else len(_stages), stage)
+        return func
+    return decorator
+
+def register_row_transform(faculty: EChange):
+    """
+    Decorator đăng ký biến đổi hàng riêng cho một khoa. Các biến đổi được ghép lại và áp dụng
+    trong lượt đọc duy nhất của bước thống kê, không thêm lượt duyệt workbook nào.
+    """
+    def decorator(func: RowTransform):
+        _row_transforms[faculty].append(func)
+        return func
+    return decorator
+
+def faculty_key(faculty_name: str) -> Optional[EChange]:
+    try:
+        return EChange(faculty_name)
+    except ValueError:
+        return None
+
+def active_stages(faculty: Optional[EChange]) -> List[Stage]:
+    return [stage for stage in _stages if stage.applies_to(faculty)]
+
+def compose_row_transforms(faculty: Optional[EChange]) -> Optional[RowTransform]:
+    transforms = list(_row_transforms.get(faculty, ())) if faculty is not None else []
+    if not transforms:
+        return None
+    if len(transforms) == 1:
+        return transforms[0]
+
+    def transform(row: tuple) -> tuple:
+        for func in transforms:
+            row = func(row)
+        return row
+    return transform
+
+def _callable_name(func: Callable) -> str:
+    return f"{getattr(func, '__module__', '')}.{getattr(func, '__qualname__', repr(func))}"
+
+def pipeline_signature(faculty: Optional[EChange]) -> str:
+    """
+    Tên các bước và biến đổi hàng áp dụng cho khoa (theo thứ tự), dùng làm một phần khóa result_cache:
+    thêm/bớt/đổi bước thì kết quả cũ không còn được dùng lại.
+    """
+    names = [f"{stage.name}={_callable_name(stage.run)}" for stage in active_stages(faculty)]
+    if faculty is not None:
+        names += [f"transform={_callable_name(func)}" for func in _row_transforms.get(faculty, ())]
+    return ";".join(names)
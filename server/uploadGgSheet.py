@@ -1,25 +1,53 @@
 import os
 import logging
 import json
-import openpyxl
+import hashlib
+import threading
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp, Request as GoogleAuthRequest
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-from googleapiclient.errors import HttpError
-from typing import Optional, List, Tuple
+from googleapiclient.http import HttpRequest
+from typing import Callable, Optional, List, Tuple
 from dotenv import load_dotenv
+from sheets_writer import SheetsWriter, execute_with_retry, request_bucket
+from metrics import count_api_call
+import sheet_index
 
 # Load biến môi trường từ file .env
 load_dotenv()
 
-# Cấu hình logging
-logging.basicConfig(level=logging.DEBUG)  # Đặt level DEBUG để ghi chi tiết
-
 # Định nghĩa CREDENTIALS_FILE sử dụng biến môi trường hoặc đường dẫn tĩnh
 CREDENTIALS_FILE = os.getenv('GOOGLE_CREDENTIALS_PATH', 'credentials.json')
 logging.debug(f"Using credentials file: {CREDENTIALS_FILE}")
 
 SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
 
+SHEETS_API_ENDPOINT = os.getenv('SHEETS_API_ENDPOINT', '')
+
+# Timeout (giây) cho kết nối HTTP tới Google Sheets API
+HTTP_TIMEOUT = int(os.getenv('SHEETS_HTTP_TIMEOUT', '60'))
+# Timeout (giây) của lần kiểm tra sheet trước khi nhận lô vào store (probe_sheet), không retry
+SHEETS_PROBE_TIMEOUT = float(os.getenv('SHEETS_PROBE_TIMEOUT', '5'))
+
+# Cache service theo nguồn credentials, dùng chung cho toàn process
+_service_cache = {}
+_service_lock = threading.Lock()
+_http_local = threading.local()
+
+def _reset_after_fork():
+    # Process con sau fork (gunicorn preload_app, process pool) giữ credentials/service đã tải sẵn
+    # nhưng không dùng chung kết nối HTTP và lock kế thừa từ process cha
+    global _service_lock, _http_local
+    _service_lock = threading.Lock()
+    _http_local = threading.local()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+# Số hàng tối đa mỗi lần gọi values().append, tránh vượt giới hạn payload của Sheets API
+UPLOAD_CHUNK_ROWS = int(os.getenv('SHEETS_UPLOAD_CHUNK_ROWS', '5000'))
+
 def extract_spreadsheet_id(url: str) -> Optional[str]:
     """
     Trích xuất ID của Google Spreadsheet từ URL.
@@ -43,133 +71,201 @@ def extract_spreadsheet_id(url: str) -> Optional[str]:
         logging.error(f"Error extracting spreadsheet ID: {e}")
         return None
 
-def connect_to_google_sheets(spreadsheet_id: str):
+def _credentials_source() -> Tuple[Tuple, Callable[[], service_account.Credentials]]:
     """
-    Thực hiện kết nối với google sheet
+    Xác định nguồn credentials (env hoặc file) và trả về (khóa cache, hàm tạo credentials).
+    Khóa thay đổi khi nội dung env hoặc file credentials thay đổi.
     """
-    try:
-        creds_json = os.getenv('GOOGLE_CREDENTIALS')
-        if creds_json:
+    creds_json = os.getenv('GOOGLE_CREDENTIALS')
+    if creds_json:
+        key = ('env', hashlib.sha256(creds_json.encode('utf-8')).hexdigest())
+        def load():
             logging.debug("Loading credentials from environment variable")
-            credentials_data = json.loads(creds_json)
-            creds = service_account.Credentials.from_service_account_info(
-                credentials_data, scopes=SCOPES
-            )
-        elif os.path.exists(CREDENTIALS_FILE):
+            return service_account.Credentials.from_service_account_info(json.loads(creds_json), scopes=SCOPES)
+        return key, load
+    if os.path.exists(CREDENTIALS_FILE):
+        key = ('file', os.path.abspath(CREDENTIALS_FILE), os.path.getmtime(CREDENTIALS_FILE))
+        def load():
             logging.debug(f"Loading credentials from file: {CREDENTIALS_FILE}")
-            creds = service_account.Credentials.from_service_account_file(
-                CREDENTIALS_FILE, scopes=SCOPES
-            )
-        else:
-            raise FileNotFoundError(f"No credentials found in env or file: {CREDENTIALS_FILE}")
-
-        service = build('sheets', 'v4', credentials=creds, cache_discovery=False)
-        logging.debug("Connected to Google Sheets API")
-        return service
+            return service_account.Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
+        return key, load
+    raise FileNotFoundError(f"No credentials found in env or file: {CREDENTIALS_FILE}")
+
+def _thread_http(key: Tuple, creds, timeout: float = HTTP_TIMEOUT) -> AuthorizedHttp:
+    """
+    Mỗi thread giữ một AuthorizedHttp riêng (httplib2 không thread-safe) cho mỗi timeout
+    để tái sử dụng kết nối keep-alive. Token được làm mới tự động trước request khi đã hết hạn.
+    """
+    clients = getattr(_http_local, 'clients', None)
+    if clients is None:
+        clients = _http_local.clients = {}
+    http = clients.get((key, timeout))
+    if http is None:
+        http = clients[(key, timeout)] = AuthorizedHttp(creds, http=httplib2.Http(timeout=timeout))
+    return http
+
+def _build_service(key: Tuple, creds):
+    def request_builder(_http, *args, **kwargs):
+        return HttpRequest(_thread_http(key, creds), *args, **kwargs)
+
+    # SHEETS_API_ENDPOINT cho phép trỏ tới server Sheets giả lập cục bộ khi test
+    client_options = {"api_endpoint": SHEETS_API_ENDPOINT} if SHEETS_API_ENDPOINT else None
+    return build('sheets', 'v4', credentials=creds, requestBuilder=request_builder, cache_discovery=False,
+                 client_options=client_options)
+
+def _get_cached_client() -> Tuple[Tuple, service_account.Credentials, object]:
+    key, load_credentials = _credentials_source()
+    with _service_lock:
+        cached = _service_cache.get(key)
+        if cached is None:
+            creds = load_credentials()
+            cached = _service_cache[key] = (key, creds, _build_service(key, creds))
+            logging.debug("Connected to Google Sheets API")
+        return cached
+
+def connect_to_google_sheets(spreadsheet_id: str):
+    """
+    Thực hiện kết nối với google sheet.
+    Service và credentials được cache theo nguồn credentials và dùng chung giữa các request/thread.
+    """
+    try:
+        return _get_cached_client()[2]
     except Exception as e:
         logging.error(f"Error connecting to Google Sheets: {e}")
         return None
 
-def get_first_empty_row(service, spreadsheet_id: str, sheet_name: str) -> int:
+def warm_up_google_sheets() -> bool:
     """
-    Tìm hàng trống tiếp theo trong Google Sheets, kiểm tra từ cột A đến H.
+    Tạo sẵn service và lấy token khi khởi động để request đầu tiên không phải chờ.
     """
     try:
-        range_name = f'{sheet_name}!A:H'
-        result = service.spreadsheets().values().get(
-            spreadsheetId=spreadsheet_id,
-            range=range_name
-        ).execute()
-        
-        values = result.get('values', [])
-        if not values:
-            logging.debug("No data in Google Sheets, starting from row 1")
-            return 1  # Bắt đầu từ hàng 1 nếu chưa có dữ liệu
-        
-        # Tìm hàng trống đầu tiên (tất cả cột A-H đều trống)
-        for row_idx, row in enumerate(values, 1):
-            if not any(cell for cell in row[:8]):  # Kiểm tra 8 cột A-H
-                logging.debug(f"Found empty row at {row_idx}")
-                return row_idx
-        # Nếu không có hàng trống, trả về hàng tiếp theo sau dữ liệu cuối
-        next_row = len(values) + 1
-        logging.debug(f"No empty row found, appending at row {next_row}")
-        return next_row
-    except HttpError as e:
-        logging.error(f"Error checking data on Google Sheets: {e}")
-        return 1  # Mặc định từ hàng 1 nếu lỗi
-
-def upload_to_google_sheets(file_path, spreadsheet_id, sheet_name, service) -> bool:
-    """
-    Upload dữ liệu từ sheet 'Thống kê nghỉ học' lên Google Sheets, ánh xạ đúng cột A-H.
+        key, creds, _ = _get_cached_client()
+        if not creds.valid:
+            creds.refresh(GoogleAuthRequest(_thread_http(key, creds).http))
+        logging.info("Google Sheets client warmed up")
+        return True
+    except FileNotFoundError as e:
+        logging.warning(f"Skipping Google Sheets warm-up: {e}")
+        return False
+    except Exception as e:
+        logging.error(f"Error warming up Google Sheets client: {e}")
+        return False
+
+def sheet_has_header(service, spreadsheet_id: str, sheet_name: str) -> bool:
+    """
+    Kiểm tra hàng 1 (A1:H1) đã có dữ liệu chưa. Chỉ đọc một hàng, không tải toàn bộ cột.
+    Lỗi API (sau khi đã retry) được ném ra để tránh ghi đè dữ liệu.
+    """
+    values = SheetsWriter(service, UPLOAD_CHUNK_ROWS).get_values(spreadsheet_id, f'{sheet_name}!A1:H1')
+    return bool(values and any(cell for cell in values[0][:8]))
+
+def probe_sheet(service, spreadsheet_id: str, sheet_name: str) -> bool:
+    """
+    Một lần values.get A1:H1, không retry và timeout ngắn (SHEETS_PROBE_TIMEOUT), để biết sheet có nhận ghi không
+    mà không làm chậm job khi Sheets không phản hồi. Không chờ token: trả về False (chưa kiểm tra) khi bucket
+    dùng chung đang cạn. Lỗi API được ném ra.
+    """
+    if not request_bucket.try_acquire():
+        return False
+    count_api_call("values.get")
+    request = service.spreadsheets().values().get(spreadsheetId=spreadsheet_id, range=f'{sheet_name}!A1:H1')
+    try:
+        key, creds, _ = _get_cached_client()
+    except Exception:
+        request.execute()
+        return True
+    request.execute(http=_thread_http(key, creds, SHEETS_PROBE_TIMEOUT))
+    return True
+
+# Header của tab chi tiết, ghi vào hàng 1 khi sheet còn trống
+SHEET_HEADERS = ["", "Ngày", "Phòng", "Họ và tên HSSV", "Khoa", "Lớp", "Giáo viên giảng dạy", "Nề nếp Buổi"]
+
+def write_rows(rows: List[List[str]], spreadsheet_id: str, sheet_name: str, service,
+               chunk_size: int = UPLOAD_CHUNK_ROWS, on_rows_written: Optional[Callable[[int], None]] = None) -> int:
+    """
+    Ghi các hàng A-H vào sau dữ liệu của sheet (thêm header nếu sheet trống), trả về số hàng cuối. Lỗi được ném ra.
+    Kiểm tra header và các lần ghi chunk được thực hiện trong sheet_lock (giữa các thread và worker process),
+    nên hai lô ghi cùng lúc không ghi header hai lần và không chen hàng vào giữa nhau.
+    on_rows_written(n) được gọi sau mỗi chunk với số hàng đầu của rows (không tính header) đã ghi xong.
+    """
+    with sheet_index.sheet_lock(spreadsheet_id, sheet_name):
+        data_to_upload, offset = rows, 0
+        if not sheet_has_header(service, spreadsheet_id, sheet_name):
+            data_to_upload, offset = [SHEET_HEADERS] + rows, 1
+
+        # SheetsWriter đếm cả hàng header, người gọi chỉ cần số hàng của rows
+        on_chunk = (lambda written: on_rows_written(max(0, written - offset))) if on_rows_written is not None else None
+        try:
+            last_row = SheetsWriter(service, chunk_size).write(spreadsheet_id, sheet_name, data_to_upload, on_chunk)
+        except BaseException:
+            # Có thể đã ghi một phần: index diff của mọi worker phải đọc lại sheet
+            sheet_index.note_write(spreadsheet_id, sheet_name)
+            raise
+        # Khóa các hàng vừa ghi được thêm vào index diff của mọi worker, không cần đọc lại sheet
+        sheet_index.note_write(spreadsheet_id, sheet_name, rows)
+        return last_row
+
+def upload_to_google_sheets(rows: List[List[str]], spreadsheet_id, sheet_name, service,
+                            chunk_size: int = UPLOAD_CHUNK_ROWS) -> bool:
+    """
+    Ghi các hàng đã ánh xạ A-H của cả lô file lên Google Sheets qua write_rows
+    (chia chunk, retry khi bị giới hạn quota), không cần đọc toàn bộ cột để tìm hàng trống.
     """
     try:
-        # Kiểm tra sheet "Thống kê nghỉ học"
-        workbook = openpyxl.load_workbook(file_path)
-        if "Thống kê nghỉ học" not in workbook.sheetnames:
-            logging.error(f"Sheet 'Thống kê nghỉ học' not found in {file_path}")
-            return False
-        
-        sheet = workbook["Thống kê nghỉ học"]
-        data_to_upload = []
-
-        # Đọc dữ liệu từ sheet "Thống kê nghỉ học"
-        for row in sheet.iter_rows(min_row=2, values_only=True):  # Bỏ hàng header
-            date_value = str(row[0]) if row[0] is not None else ""  # Cột A: Ngày
-            full_name = str(row[1]) if row[1] is not None else ""   # Cột B: Họ và tên HSSV
-            faculty = str(row[2]) if row[2] is not None else ""     # Cột C: Khoa
-            class_name = str(row[3]) if row[3] is not None else ""  # Cột D: Lớp
-            teacher = str(row[4]) if row[4] is not None else ""     # Cột E: Giáo viên giảng dạy
-            attendance = str(row[5]) if row[5] is not None else ""  # Cột F: Nề nếp
-            session = str(row[6]) if row[6] is not None else ""     # Cột G: Buổi
-            room = str(row[7]) if row[7] is not None else ""        # Cột H: Phòng
-
-            # Gộp "Nề nếp" và "Buổi" thành một chuỗi cho cột H
-            combined_attendance = f"{attendance} {session}".strip() if session else attendance
-
-            # Ánh xạ dữ liệu theo thứ tự cột A-H của Google Sheets
-            mapped_row = [
-                "",              # Cột A: Để trống
-                date_value,      # Cột B: Ngày
-                room,            # Cột C: Phòng
-                full_name,       # Cột D: Họ và tên HSSV
-                faculty,         # Cột E: Khoa
-                class_name,      # Cột F: Lớp
-                teacher,         # Cột G: Giáo viên giảng dạy
-                combined_attendance  # Cột H: Nề nếp Buổi
-            ]
-            data_to_upload.append(mapped_row)
-        
-        if not data_to_upload:
-            logging.warning(f"No data to upload from {file_path}")
+        if not rows:
+            logging.warning("No data to upload")
             return True  # Vẫn trả về True nếu không có dữ liệu để upload
 
-        # Thêm header nếu cần
-        headers = ["", "Ngày", "Phòng", "Họ và tên HSSV", "Khoa", "Lớp", "Giáo viên giảng dạy", "Nề nếp Buổi"]
-        start_row = get_first_empty_row(service, spreadsheet_id, sheet_name)
-        
-        # Nếu sheet trống, thêm header vào hàng 1 và dữ liệu từ hàng 2
-        if start_row == 1:
-            data_to_upload.insert(0, headers)
-            start_row = 1
-        else:
-            # Nếu đã có dữ liệu, chỉ thêm dữ liệu mới vào hàng trống tiếp theo
-            start_row = max(start_row, 2)  # Đảm bảo không ghi đè header
-
-        # Upload dữ liệu
-        range_name = f"{sheet_name}!A{start_row}"
-        body = {"values": data_to_upload}
-        service.spreadsheets().values().update(
-            spreadsheetId=spreadsheet_id,
-            range=range_name,
-            valueInputOption="RAW",
-            body=body
-        ).execute()
-        
-        logging.info(f"Successfully uploaded {file_path} to Google Sheets starting at row {start_row}")
+        last_row = write_rows(rows, spreadsheet_id, sheet_name, service, chunk_size)
+        logging.info(f"Successfully uploaded {len(rows)} rows to Google Sheets sheet {sheet_name}, last row {last_row}")
+        return True
+    except Exception as e:
+        logging.error(f"Error uploading to Google Sheets: {e}")
+        return False
+
+def write_summary_sheet(rows: List[list], spreadsheet_id: str, summary_sheet_name: str, service,
+                        detail_sheet_name: Optional[str] = None) -> bool:
+    """
+    Ghi bảng thống kê vào một tab riêng: tạo tab (ngay sau tab chi tiết) nếu chưa có,
+    nếu đã có thì xóa nội dung cũ rồi ghi lại từ A1. Tổng cộng 3 request, không phụ thuộc số bản ghi.
+    Cả chuỗi request chạy trong sheet_lock của tab thống kê.
+    """
+    try:
+        sheets = service.spreadsheets()
+        # Hai job thống kê cùng tab (nhiều thread/worker) không được cùng addSheet hay chen clear/update vào nhau
+        with sheet_index.sheet_lock(spreadsheet_id, summary_sheet_name):
+            metadata = execute_with_retry(lambda: sheets.get(
+                spreadsheetId=spreadsheet_id,
+                fields="sheets.properties(title,index)"
+            ), "spreadsheets.get")
+            existing = {sheet['properties']['title']: sheet['properties'] for sheet in metadata.get('sheets', [])}
+
+            if summary_sheet_name in existing:
+                execute_with_retry(lambda: sheets.values().clear(
+                    spreadsheetId=spreadsheet_id,
+                    range=summary_sheet_name,
+                    body={}
+                ), "values.clear")
+            else:
+                properties = {"title": summary_sheet_name}
+                if detail_sheet_name in existing:
+                    properties["index"] = existing[detail_sheet_name].get('index', 0) + 1
+                # addSheet không idempotent: chỉ retry khi bị từ chối vì quota
+                execute_with_retry(lambda: sheets.batchUpdate(
+                    spreadsheetId=spreadsheet_id,
+                    body={"requests": [{"addSheet": {"properties": properties}}]}
+                ), "spreadsheets.batchUpdate", retry_statuses={429}, retry_transport=False)
+
+            execute_with_retry(lambda: sheets.values().update(
+                spreadsheetId=spreadsheet_id,
+                range=f"{summary_sheet_name}!A1",
+                valueInputOption="RAW",
+                body={"values": rows}
+            ), "values.update")
+        logging.info(f"Wrote {len(rows)} summary rows to sheet {summary_sheet_name}")
         return True
     except Exception as e:
-        logging.error(f"Error uploading {file_path} to Google Sheets: {e}")
+        logging.error(f"Error writing summary sheet {summary_sheet_name}: {e}")
         return False
 
 # Xóa các hàm không cần thiết (read_excel_data, push_data_to_google_sheets) để đơn giản hóa
\ No newline at end of file
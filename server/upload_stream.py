@@ -0,0 +1,124 @@
+import os
+import logging
+import tempfile
+from typing import BinaryIO, Dict, List, Optional, Tuple
+
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NEED_DATA
+
+# Giới hạn kích thước mỗi file và cả request (byte)
+MAX_UPLOAD_FILE_BYTES = int(os.getenv('MAX_UPLOAD_FILE_BYTES', str(20 * 1024 * 1024)))
+MAX_UPLOAD_REQUEST_BYTES = int(os.getenv('MAX_UPLOAD_REQUEST_BYTES', str(200 * 1024 * 1024)))
+# Phần của mỗi file được giữ trong bộ nhớ, vượt quá thì chuyển sang file tạm trên đĩa
+UPLOAD_SPOOL_BYTES = int(os.getenv('UPLOAD_SPOOL_BYTES', str(1024 * 1024)))
+# Kích thước mỗi lần đọc từ stream của request
+READ_CHUNK_BYTES = 64 * 1024
+# Giới hạn cho các trường form dạng chữ (URL, tên sheet, khoa...)
+MAX_FIELD_BYTES = 64 * 1024
+
+class UploadTooLarge(Exception):
+    pass
+
+def _format_size(size: int) -> str:
+    if size >= 1024 * 1024:
+        return f"{size / (1024 * 1024):.0f} MB"
+    return f"{max(1, size // 1024)} KB"
+
+class SpooledUpload:
+    """
+    Nội dung một file upload đã nhận: giữ trong bộ nhớ tới UPLOAD_SPOOL_BYTES, phần lớn hơn nằm trên đĩa.
+    read() trả về toàn bộ nội dung và giải phóng bộ nhớ đệm/file tạm ngay sau đó.
+    """
+
+    __slots__ = ("filename", "size", "_file")
+
+    def __init__(self, filename: str, spool_bytes: int = UPLOAD_SPOOL_BYTES):
+        self.filename = filename
+        self.size = 0
+        self._file: Optional[BinaryIO] = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+
+    def write(self, data: bytes):
+        self._file.write(data)
+        self.size += len(data)
+
+    def read(self) -> bytes:
+        if self._file is None:
+            raise ValueError(f"Upload '{self.filename}' was already read")
+        self._file.seek(0)
+        data = self._file.read()
+        self.close()
+        return data
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def parse_multipart_stream(stream: BinaryIO, content_type: str, content_length: Optional[int],
+                           file_field: str = 'files', max_file_bytes: int = MAX_UPLOAD_FILE_BYTES,
+                           max_request_bytes: int = MAX_UPLOAD_REQUEST_BYTES) -> Tuple[Dict[str, str], List[SpooledUpload]]:
+    """
+    Đọc body multipart/form-data theo từng chunk (không để Werkzeug đệm cả body) và ghi từng file
+    vào SpooledUpload riêng ngay khi dữ liệu tới. Vượt giới hạn file/request thì dừng đọc và ném UploadTooLarge.
+    Trả về (các trường form, các file của trường file_field theo thứ tự gửi).
+    """
+    if content_length is not None and content_length > max_request_bytes:
+        raise UploadTooLarge(f"Request vượt quá giới hạn {_format_size(max_request_bytes)}")
+
+    mimetype, options = parse_options_header(content_type or '')
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
+        raise ValueError("Request không phải multipart/form-data")
+
+    decoder = MultipartDecoder(boundary.encode('latin-1'), max_form_memory_size=MAX_FIELD_BYTES)
+    form: Dict[str, str] = {}
+    files: List[SpooledUpload] = []
+    field_name: Optional[str] = None
+    field_data = bytearray()
+    current: Optional[SpooledUpload] = None
+    received = 0
+
+    try:
+        finished = False
+        while not finished:
+            chunk = stream.read(READ_CHUNK_BYTES)
+            received += len(chunk)
+            if received > max_request_bytes:
+                raise UploadTooLarge(f"Request vượt quá giới hạn {_format_size(max_request_bytes)}")
+            decoder.receive_data(chunk or None)
+
+            event = decoder.next_event()
+            while event is not NEED_DATA:
+                if isinstance(event, File):
+                    current = None
+                    if event.name == file_field:
+                        current = SpooledUpload(event.filename or '')
+                        files.append(current)
+                elif isinstance(event, Field):
+                    field_name = event.name
+                    field_data.clear()
+                elif isinstance(event, Data):
+                    if field_name is not None:
+                        field_data += event.data
+                        if not event.more_data:
+                            form[field_name] = field_data.decode('utf-8', 'replace')
+                            field_name = None
+                    elif current is not None:
+                        if current.size + len(event.data) > max_file_bytes:
+                            raise UploadTooLarge(f"File '{current.filename}' vượt quá giới hạn "
+                                                 f"{_format_size(max_file_bytes)}")
+                        current.write(event.data)
+                elif isinstance(event, Epilogue):
+                    finished = True
+                    break
+                event = decoder.next_event()
+
+            if not chunk and not finished:
+                raise ValueError("Body multipart kết thúc trước khi đủ dữ liệu")
+    except Exception:
+        for upload in files:
+            upload.close()
+        raise
+
+    logging.debug(f"Received {len(files)} files, {received} bytes in streaming mode")
+    return form, files
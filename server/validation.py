@@ -0,0 +1,100 @@
+from typing import List, NamedTuple, Optional, Tuple
+
+from handleExcel import build_session_columns
+
+# Giới hạn số lỗi giữ lại trong báo cáo (file hỏng nặng không làm phình bộ nhớ/response)
+MAX_REPORTED_ISSUES = 200
+# Số hàng lỗi liệt kê trong thông báo dạng chuỗi
+MAX_ROWS_IN_MESSAGE = 10
+
+class ValidationIssue(NamedTuple):
+    row: int        # Số hàng trên Excel (0 nếu lỗi cả file)
+    column: str     # Cột Excel ("" nếu không gắn với cột cụ thể)
+    reason: str
+
+class ValidationReport:
+    """
+    Kết quả kiểm tra một sheet điểm danh: toàn bộ lỗi tìm được và chỉ mục ngày/buổi của hàng 1
+    (session_columns) để bước thống kê dùng lại, không phải đọc lại header.
+    """
+
+    def __init__(self):
+        self.issues: List[ValidationIssue] = []
+        self.total_issues = 0
+        # Hàng thiếu họ tên được đếm riêng, không phụ thuộc giới hạn MAX_REPORTED_ISSUES của issues
+        self.name_rows: List[int] = []
+        self.name_row_count = 0
+        self._last_name_row = 0
+        self.row_count = 0
+        self.session_columns: Optional[List[Tuple[int, str, int]]] = None
+        self.has_date = False
+        self.error: Optional[str] = None
+
+    @property
+    def is_valid(self) -> bool:
+        return self.error is None and self.total_issues == 0
+
+    def add(self, row: int, column: str, reason: str):
+        self.total_issues += 1
+        if len(self.issues) < MAX_REPORTED_ISSUES:
+            self.issues.append(ValidationIssue(row, column, reason))
+        # Hàng được thêm theo thứ tự tăng dần nên chỉ cần so với hàng cuối để không đếm hai lần (thiếu cả C và D)
+        if column in ("C", "D") and row != self._last_name_row:
+            self._last_name_row = row
+            self.name_row_count += 1
+            if len(self.name_rows) < MAX_ROWS_IN_MESSAGE:
+                self.name_rows.append(row)
+
+    def message(self) -> str:
+        """
+        Thông báo dạng chuỗi, giữ cách diễn đạt cũ ("Thiếu họ tên ở hàng 5.") và gộp mọi lỗi.
+        """
+        if self.error is not None:
+            return f"Lỗi kiểm tra dữ liệu: {self.error}"
+        if self.row_count < 4:
+            return "File cần ít nhất 4 hàng."
+
+        parts = []
+        if self.name_row_count:
+            listed = ", ".join(str(row) for row in self.name_rows)
+            more = self.name_row_count - MAX_ROWS_IN_MESSAGE
+            suffix = f" (và {more} hàng khác)" if more > 0 else ""
+            parts.append(f"Thiếu họ tên ở hàng {listed}{suffix}.")
+        if not self.has_date:
+            parts.append("Không tìm thấy ngày hợp lệ.")
+        return " ".join(parts)
+
+    def to_list(self) -> List[dict]:
+        return [issue._asdict() for issue in self.issues]
+
+def validate_sheet(sheet) -> ValidationReport:
+    """
+    Kiểm tra sheet trong một lượt đọc streaming (iter_rows values_only):
+    hàng 1 phải có ít nhất một ngày dạng "dd/mm" từ cột 7, từ hàng 4 trở đi cột C (họ đệm) và D (tên) không được trống.
+    Thu thập mọi lỗi thay vì dừng ở lỗi đầu tiên.
+    """
+    report = ValidationReport()
+    try:
+        for row_idx, row in enumerate(sheet.iter_rows(values_only=True), 1):
+            report.row_count = row_idx
+            if row_idx == 1:
+                report.session_columns = build_session_columns(row)
+                report.has_date = any(isinstance(value, str) and '/' in value for value in row[6:])
+                continue
+            if row_idx < 4:
+                continue
+            row_len = len(row)
+            if not (row[2] if row_len > 2 else None):
+                report.add(row_idx, "C", "Thiếu họ đệm")
+            if not (row[3] if row_len > 3 else None):
+                report.add(row_idx, "D", "Thiếu tên")
+
+        if report.row_count < 4:
+            report.add(0, "", "File cần ít nhất 4 hàng.")
+        if report.session_columns is None:
+            report.session_columns = []
+        if not report.has_date:
+            report.add(1, "", "Không tìm thấy ngày hợp lệ.")
+    except Exception as e:
+        report.error = str(e)
+    return report
@@ -0,0 +1,4 @@
+# Entry point WSGI cho production: gunicorn -c gunicorn.conf.py (cấu hình đã trỏ tới wsgi:application)
+from app import app
+
+application = app